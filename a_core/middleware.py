@@ -0,0 +1,145 @@
+"""
+Per-request hot-path instrumentation.
+
+ServerTimingMiddleware counts and times, for each request, the Stripe API
+calls (via a_stripe.client.request_recorder), the DB queries (via
+connection.execute_wrapper) and template rendering (via
+a_core.template_backends). The totals go out as a Server-Timing header and
+one key=value log line; requests slower than SLOW_REQUEST_MS are also
+logged with every call and query they made.
+
+Under ASGI the queries run on sync_to_async threads rather than the event
+loop, so the async path installs _timed_query on that thread's connection;
+it records into whichever request's timings are current.
+"""
+from contextvars import ContextVar
+import json
+import logging
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connection
+
+from a_stripe.client import request_recorder
+
+logger = logging.getLogger(__name__)
+
+current_timings = ContextVar('request_timings', default=None)
+
+
+class RequestTimings:
+    """Counters for one request. Stripe calls may be recorded from pool threads, hence the lock."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.stripe_calls = []
+        self.queries = []
+        self.templates = []
+        self.template_depth = 0
+
+    def record_stripe(self, endpoint, elapsed_ms, error=False):
+        with self._lock:
+            self.stripe_calls.append({'endpoint': endpoint, 'ms': round(elapsed_ms, 1), 'error': error})
+
+    def record_template(self, name, elapsed_ms, nested=False):
+        with self._lock:
+            self.templates.append({'template': name, 'ms': round(elapsed_ms, 1), 'nested': nested})
+
+    def db_wrapper(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            with self._lock:
+                self.queries.append({'sql': sql[:200], 'ms': round((time.perf_counter() - started) * 1000, 1)})
+
+    def summary(self):
+        with self._lock:
+            return {
+                'total_ms': round((time.perf_counter() - self.started) * 1000, 1),
+                'stripe_calls': len(self.stripe_calls),
+                'stripe_ms': round(sum(call['ms'] for call in self.stripe_calls), 1),
+                'db_queries': len(self.queries),
+                'db_ms': round(sum(query['ms'] for query in self.queries), 1),
+                # A nested render's time is already part of the render around it
+                'template_ms': round(sum(t['ms'] for t in self.templates if not t['nested']), 1),
+            }
+
+    def breakdown(self):
+        with self._lock:
+            return {'stripe': list(self.stripe_calls), 'db': list(self.queries), 'templates': list(self.templates)}
+
+
+def server_timing_header(summary):
+    return ', '.join([
+        f'stripe;dur={summary["stripe_ms"]};desc="{summary["stripe_calls"]} calls"',
+        f'db;dur={summary["db_ms"]};desc="{summary["db_queries"]} queries"',
+        f'tpl;dur={summary["template_ms"]}',
+        f'total;dur={summary["total_ms"]}',
+    ])
+
+
+def _timed_query(execute, sql, params, many, context):
+    timings = current_timings.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    return timings.db_wrapper(execute, sql, params, many, context)
+
+
+def _install_query_timer():
+    if _timed_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_timed_query)
+
+
+class ServerTimingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        timings = RequestTimings()
+        timings_token = current_timings.set(timings)
+        stripe_token = request_recorder.set(timings.record_stripe)
+        try:
+            with connection.execute_wrapper(timings.db_wrapper):
+                response = self.get_response(request)
+        finally:
+            current_timings.reset(timings_token)
+            request_recorder.reset(stripe_token)
+        return self.finish(request, response, timings)
+
+    async def __acall__(self, request):
+        timings = RequestTimings()
+        timings_token = current_timings.set(timings)
+        stripe_token = request_recorder.set(timings.record_stripe)
+        try:
+            await sync_to_async(_install_query_timer)()
+            response = await self.get_response(request)
+        finally:
+            current_timings.reset(timings_token)
+            request_recorder.reset(stripe_token)
+        return self.finish(request, response, timings)
+
+    def finish(self, request, response, timings):
+        summary = timings.summary()
+        if settings.SERVER_TIMING_HEADER:
+            response['Server-Timing'] = server_timing_header(summary)
+
+        line = ' '.join(f'{key}={value}' for key, value in summary.items())
+        logger.info('request method=%s path=%s status=%s %s', request.method, request.path, response.status_code, line)
+        if summary['total_ms'] >= settings.SLOW_REQUEST_MS:
+            logger.warning(
+                'slow request method=%s path=%s %s breakdown=%s',
+                request.method, request.path, line, json.dumps(timings.breakdown()),
+            )
+        return response
@@ -35,6 +35,9 @@ BASE_URL = 'http://localhost:8000'
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = os.getenv('SECRET_KEY')
 STRIPE_TEST_KEY = os.environ.get('STRIPE_TEST_KEY')
+STRIPE_WEBHOOK_SECRET = os.environ.get('STRIPE_WEBHOOK_SECRET')
+# Serve the async storefront views (a_stripe.async_views); only useful under a_core.asgi
+STRIPE_ASYNC_VIEWS = os.environ.get('STRIPE_ASYNC_VIEWS') == 'true'
 # print(STRIPE_TEST_KEY)
 
 # SECURITY WARNING: don't run with debug turned on in production!
@@ -69,6 +72,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Outermost, so its timings cover the rest of the middleware (session save included)
+    'a_core.middleware.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -90,7 +95,7 @@ ROOT_URLCONF = 'a_core.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'a_core.template_backends.TimedDjangoTemplates',
         'DIRS': [ BASE_DIR / 'templates'],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -189,12 +194,73 @@ LOGGING = {
         'handlers': ['console'],
         'level': 'INFO',
     },
+    'loggers': {
+        # Only slow requests by default; set to INFO for one line per request
+        'a_core.middleware': {
+            'level': os.environ.get('REQUEST_LOG_LEVEL', 'WARNING'),
+        },
+    },
 }
 
 
 CART_SESSION_ID = 'cart'
+# Catalog version the anonymous cart's line prices are from
+CART_VERSION_SESSION_ID = 'cart_version'
+# Cap on the cart kept in the session (so it stays small enough for a cookie session too)
+CART_MAX_LINES = int(os.environ.get('CART_MAX_LINES', 50))
+CART_MAX_QUANTITY = 10
+
+# Catalog data and rendered fragments. Local memory is per process; with several
+# processes set CACHE_BACKEND=file so they share one cache.
+SHARED_CACHE = os.environ.get('CACHE_BACKEND') == 'file'
+if SHARED_CACHE:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.environ.get('CACHE_LOCATION', BASE_DIR / '.cache'),
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'iotbay',
+            'OPTIONS': {'MAX_ENTRIES': 5000},
+        },
+    }
+
+# With a shared cache, sessions are read from it and only written through to the database when
+# they change; a per-process cache would hand other processes stale sessions.
+# signed_cookies avoids the database entirely.
+SESSION_ENGINE = os.environ.get('SESSION_ENGINE', (
+    'django.contrib.sessions.backends.cached_db' if SHARED_CACHE else 'django.contrib.sessions.backends.db'
+))
+
+# Catalog entries are evicted by Stripe webhooks, so they can be kept for a long time
+CATALOG_CACHE_TIMEOUT = 60 * 60 * 24
+# How long a product id that neither the mirror nor Stripe knows is answered without asking Stripe
+CATALOG_MISS_TIMEOUT = 60 * 5
+# How long a process reuses its last read of the catalog version (seconds): the delay before
+# a change made by the webhook worker shows up in the web processes
+CATALOG_VERSION_TTL = float(os.environ.get('CATALOG_VERSION_TTL', 2))
+
+# Most Stripe requests in flight per process (a_stripe.client), also the size of the a_stripe.fetch pool;
+# and the per-batch deadline for that pool in seconds
+STRIPE_MAX_CONCURRENCY = int(os.environ.get('STRIPE_MAX_CONCURRENCY', 8))
+STRIPE_FETCH_TIMEOUT = float(os.environ.get('STRIPE_FETCH_TIMEOUT', 10))
+
+# Shared Stripe HTTP client (a_stripe.client): timeouts in seconds and retries on network errors
+STRIPE_CONNECT_TIMEOUT = float(os.environ.get('STRIPE_CONNECT_TIMEOUT', 5))
+STRIPE_READ_TIMEOUT = float(os.environ.get('STRIPE_READ_TIMEOUT', 30))
+STRIPE_MAX_NETWORK_RETRIES = int(os.environ.get('STRIPE_MAX_NETWORK_RETRIES', 2))
 SESSION_COOKIE_AGE = 86400
 
+# Per-request timings (a_core.middleware): Server-Timing header (exposes internals, so dev only by default)
+# and the threshold in ms above which a request is logged with its full call breakdown
+SERVER_TIMING_HEADER = os.environ.get('SERVER_TIMING_HEADER', str(DEBUG)).lower() == 'true'
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 1000))
+
 CSRF_TRUSTED_ORIGINS=["http://localhost:8000"]
 
 
@@ -0,0 +1,40 @@
+"""
+DjangoTemplates backend that reports render time to the request timings
+collected by a_core.middleware.ServerTimingMiddleware.
+"""
+import time
+
+from django.template.backends.django import DjangoTemplates
+
+from .middleware import current_timings
+
+
+class TimedTemplate:
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        timings = current_timings.get()
+        if timings is None:
+            return self.template.render(context, request)
+
+        # Template tags may render other templates through the backend while this one renders
+        nested = timings.template_depth > 0
+        timings.template_depth += 1
+        started = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            timings.template_depth -= 1
+            timings.record_template(self.template.template.name, (time.perf_counter() - started) * 1000, nested)
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
@@ -0,0 +1,89 @@
+from functools import partial
+import json
+
+from asgiref.sync import async_to_sync, iscoroutinefunction, sync_to_async
+import stripe
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.test import AsyncRequestFactory, TestCase, override_settings
+from django.urls import reverse
+
+from a_core.middleware import ServerTimingMiddleware
+
+from a_stripe.bench import FakeStripe
+from a_stripe.client import request_recorder
+from a_stripe.fetch import fetch_all
+
+
+@override_settings(SERVER_TIMING_HEADER=True, SLOW_REQUEST_MS=60_000)
+class ServerTimingMiddlewareTests(TestCase):
+    """Tests for the per-request Stripe, DB and template timings"""
+
+    def setUp(self):
+        self.fake = FakeStripe().__enter__()
+        self.addCleanup(self.fake.__exit__)
+        self.fake.set_catalog(2)
+        cache.clear()
+        api_base, api_key = stripe.api_base, stripe.api_key
+        stripe.api_base, stripe.api_key = self.fake.url, 'sk_test_timing'
+        self.addCleanup(setattr, stripe, 'api_base', api_base)
+        self.addCleanup(setattr, stripe, 'api_key', api_key)
+
+    def timings(self, response):
+        return {
+            part.strip().split(';')[0]: part.strip()
+            for part in response['Server-Timing'].split(',')
+        }
+
+    def test_header_counts_stripe_calls_and_queries(self):
+        # Not mirrored yet, so the product page fetches it from Stripe
+        with self.assertLogs('a_core.middleware', level='INFO') as logs, self.assertLogs('stripe', level='INFO'):
+            response = self.client.get(reverse('product', args=['prod_bench00001']))
+
+        self.assertEqual(response.status_code, 200)
+        timings = self.timings(response)
+        self.assertIn('desc="1 calls"', timings['stripe'])
+        self.assertNotIn('desc="0 queries"', timings['db'])
+        self.assertIn('tpl;dur=', timings['tpl'])
+        self.assertIn('total;dur=', timings['total'])
+        self.assertIn('stripe_calls=1', logs.output[0])
+        self.assertIn('path=/shop/product/prod_bench00001', logs.output[0])
+
+    @override_settings(SLOW_REQUEST_MS=0)
+    def test_slow_requests_log_breakdown(self):
+        with self.assertLogs('a_core.middleware', level='WARNING') as logs, self.assertLogs('stripe', level='INFO'):
+            self.client.get(reverse('product', args=['prod_bench00001']))
+
+        breakdown = json.loads(logs.output[0].split('breakdown=', 1)[1])
+        self.assertEqual([call['endpoint'] for call in breakdown['stripe']], ['GET /v1/products'])
+        self.assertTrue(any('a_stripe_product' in query['sql'] for query in breakdown['db']))
+        self.assertIn('a_stripe/product.html', [template['template'] for template in breakdown['templates']])
+
+    @override_settings(SERVER_TIMING_HEADER=False)
+    def test_header_can_be_disabled(self):
+        with self.assertLogs('a_core.middleware', level='INFO'):
+            response = self.client.get(reverse('shop'))
+        self.assertNotIn('Server-Timing', response)
+
+    def test_pool_calls_are_attributed_to_the_request(self):
+        recorded = []
+        token = request_recorder.set(recorded.append)
+        try:
+            fetch_all([partial(lambda n: request_recorder.get()(n), n) for n in range(3)])
+        finally:
+            request_recorder.reset(token)
+        self.assertEqual(sorted(recorded), [0, 1, 2])
+
+    def test_async_requests_are_timed(self):
+        async def view(request):
+            await sync_to_async(User.objects.count)()
+            return HttpResponse('ok')
+
+        middleware = ServerTimingMiddleware(view)
+        self.assertTrue(iscoroutinefunction(middleware))
+        with self.assertLogs('a_core.middleware', level='INFO') as logs:
+            response = async_to_sync(middleware)(AsyncRequestFactory().get('/async/'))
+
+        self.assertIn('desc="1 queries"', self.timings(response)['db'])
+        self.assertIn('path=/async/', logs.output[0])
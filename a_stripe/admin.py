@@ -3,7 +3,22 @@ from .models import *
 
 # Register your models here.
 
+class PastOrderInline(admin.TabularInline):
+    model = PastOrder
+    extra = 0
+
+
+@admin.register(Order)
+class OrderAdmin(admin.ModelAdmin):
+    list_display = ['id', 'user', 'total', 'currency', 'item_count', 'created_at']
+    inlines = [PastOrderInline]
+
+
 admin.site.register(ShippingInfo)
 admin.site.register(CheckoutSession)
 admin.site.register(UserPayment)
 admin.site.register(PastOrder)
+admin.site.register(Product)
+admin.site.register(Price)
+admin.site.register(StripeEvent)
+admin.site.register(CartItem)
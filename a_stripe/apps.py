@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class AStripeConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'a_stripe'
+
+    def ready(self):
+        from .client import configure
+        configure()
+        import a_stripe.signals
@@ -0,0 +1,121 @@
+"""
+Async versions of the Stripe-backed storefront views, for running under ASGI.
+
+Enabled with STRIPE_ASYNC_VIEWS (see a_stripe/urls.py). Independent Stripe
+calls are awaited together, each in its own worker thread, so a view waits
+about as long as its slowest call rather than the sum of them. ORM and session
+work goes through sync_to_async, which keeps it on Django's shared thread.
+"""
+import asyncio
+
+import stripe
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.decorators import login_required
+from django.http import HttpResponse, HttpResponseRedirect
+from django.shortcuts import render
+
+from .cart import Cart
+from .forms import ShippingForm
+from .models import CheckoutSession, Order, ShippingInfo
+from .utils import create_checkout_session
+from .views import product_context, record_payment, save_shipping_info, shop_grid_context
+
+arender = sync_to_async(render)
+
+
+def stripe_call(func, *args, **kwargs):
+    """Run a blocking Stripe call outside Django's shared thread so several can overlap."""
+    return sync_to_async(func, thread_sensitive=False)(*args, **kwargs)
+
+
+async def shop_view(request):
+    query = request.GET.get('q', '').strip()
+    cursor = request.GET.get('cursor')
+    context = await sync_to_async(shop_grid_context)(query, cursor)
+
+    # Later batches are requested by the grid's "revealed" sentinel
+    if request.htmx and cursor:
+        return await arender(request, 'a_stripe/partials/shop-grid.html', context)
+    return await arender(request, 'a_stripe/shop.html', context)
+
+
+async def product_view(request, product_id):
+    context = await sync_to_async(product_context)(request, product_id)
+    return await arender(request, 'a_stripe/product.html', context)
+
+
+async def cart_view(request):
+    quantity = list(range(1, settings.CART_MAX_QUANTITY + 1))
+    return await arender(request, 'a_stripe/cart.html', {'quantity_range': quantity})
+
+
+@login_required
+async def checkout_view(request):
+    user = await request.auser()
+    # Try to get existing shipping info for the user
+    shipping_info = await ShippingInfo.objects.filter(user=user).afirst()
+    cart = await sync_to_async(Cart)(request)
+
+    if request.method == 'POST':
+        # Use the instance parameter to update existing info if it exists
+        form = ShippingForm(request.POST, instance=shipping_info)
+        if await sync_to_async(form.is_valid)():
+            try:
+                shipping_info = await sync_to_async(save_shipping_info)(form, user)
+
+                # Price the cart on the ORM thread; the Stripe call below then reads the snapshot.
+                total_cost = await sync_to_async(cart.get_total_cost)()
+                checkout_session = await stripe_call(create_checkout_session, cart, shipping_info.email)
+
+                await CheckoutSession.objects.acreate(
+                    checkout_id=checkout_session.id,
+                    shipping_info=shipping_info,
+                    total_cost=total_cost
+                )
+
+                if not checkout_session.url:
+                    return HttpResponse("ERROR: Checkout session URL is empty!")
+
+                return HttpResponseRedirect(checkout_session.url)
+
+            except Exception as e:
+                context = {
+                    'cart': cart,
+                    'form': form,
+                    'error': f'Unable to process payment: {str(e)}'
+                }
+                return await arender(request, 'a_stripe/checkout.html', context)
+    else:
+        # For GET requests, pre-fill the form with existing info or just the email
+        if shipping_info:
+            form = ShippingForm(instance=shipping_info)
+        else:
+            form = ShippingForm(initial={'email': user.email})
+
+    context = {
+        'cart': cart,
+        'form': form
+    }
+    return await arender(request, 'a_stripe/checkout.html', context)
+
+
+async def payment_successful(request):
+    checkout_session_id = request.GET.get('session_id', None)
+    customer = None  # Default if session retrieval fails
+
+    if checkout_session_id:
+        # Already recorded (a reload, or the webhook got there first): the line items aren't needed
+        recorded = await Order.objects.filter(stripe_checkout_id=checkout_session_id).aexists()
+
+        # The customer comes back expanded on the session, so both calls can start at once.
+        calls = [stripe_call(stripe.checkout.Session.retrieve, checkout_session_id, expand=['customer'])]
+        if not recorded:
+            calls.append(stripe_call(stripe.checkout.Session.list_line_items, checkout_session_id, limit=100))
+        session, *line_items = await asyncio.gather(*calls)
+        line_items = line_items[0] if line_items else None
+        customer = session.customer
+
+        await sync_to_async(record_payment)(request, session, customer.id, line_items)
+
+    return await arender(request, 'a_stripe/payment_successful.html', {'customer': customer})
@@ -0,0 +1,341 @@
+"""
+Storefront latency benchmark against a local Stripe stand-in.
+
+FakeStripe is a small HTTP server that answers the Stripe endpoints the shop
+uses from a generated catalog, sleeping latency_ms before every response.
+run_benchmark() points the stripe library at it, mirrors the catalog, then
+times each storefront view through the test client for every catalog and
+cart size, counting Stripe calls (at the server) and DB queries per request.
+The bench_storefront command runs it against a throwaway test database.
+"""
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+import json
+import math
+import re
+import statistics
+import threading
+import time
+from urllib.parse import parse_qsl, urlsplit
+
+import stripe
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from .cache import catalog_version
+from .cart import delete_cart_items, unit_prices, upsert_cart_items
+from .client import endpoint_name
+from .models import Product, SyncCursor
+from .sync import full_sync
+
+CREATED_BASE = 1_700_000_000
+
+SHIPPING = {
+    'email': 'bench@example.com',
+    'first_name': 'Bench',
+    'last_name': 'Mark',
+    'address_line_one': '1 Bench St',
+    'city': 'Sydney',
+    'zip_code': '2000',
+}
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    return ordered[max(math.ceil(pct / 100 * len(ordered)) - 1, 0)]
+
+
+def _array_param(params, name):
+    # Stripe form-encodes lists as ids[0]=...&ids[1]=...
+    return [value for key, value in params if re.fullmatch(rf'{name}\[\d*\]', key)]
+
+
+class FakeStripe:
+    """Threaded HTTP stand-in for the Stripe API, serving a generated catalog."""
+
+    def __init__(self, latency_ms=0):
+        self.latency_ms = latency_ms
+        self.products = []
+        self.names = {}
+        self.prices = {}
+        self.sessions = {}
+        self.calls = {}
+        self._ids = count(1)
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f'http://{host}:{port}'
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def set_catalog(self, size):
+        self.products = [
+            {
+                'id': f'prod_bench{index:05}',
+                'object': 'product',
+                'name': f'Bench Product {index}',
+                'description': f'Benchmark product number {index}',
+                'images': [f'https://example.com/bench/{index}.jpg'],
+                'metadata': {'category': 'shop', 'sku': f'BENCH-{index:05}'},
+                'active': True,
+                'default_price': f'price_bench{index:05}',
+                'created': CREATED_BASE + index,
+            }
+            for index in range(size)
+        ]
+        self.names = {product['id']: product['name'] for product in self.products}
+        self.prices = {
+            product['default_price']: {
+                'id': product['default_price'],
+                'object': 'price',
+                'product': product['id'],
+                'unit_amount': 1000 + index,
+                'currency': 'usd',
+                'active': True,
+                'created': CREATED_BASE + index,
+            }
+            for index, product in enumerate(self.products)
+        }
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls = {}
+
+    def call_count(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    def _page(self, objects, params, url):
+        limit = int(dict(params).get('limit', 10))
+        starting_after = dict(params).get('starting_after')
+        if starting_after:
+            ids = [obj['id'] for obj in objects]
+            objects = objects[ids.index(starting_after) + 1:] if starting_after in ids else []
+        return {'object': 'list', 'url': url, 'data': objects[:limit], 'has_more': len(objects) > limit}
+
+    def _product(self, product, expand):
+        if 'data.default_price' in expand:
+            product = dict(product, default_price=self.prices[product['default_price']])
+        return product
+
+    def respond(self, method, path, params):
+        """The JSON body and status for one request."""
+        expand = _array_param(params, 'expand')
+        parts = path.strip('/').split('/')[1:]  # drop the v1 prefix
+
+        if parts == ['products']:
+            ids = set(_array_param(params, 'ids'))
+            products = [self._product(p, expand) for p in self.products if not ids or p['id'] in ids]
+            return 200, self._page(products, params, '/v1/products')
+        if parts[0] == 'products' and len(parts) == 2:
+            product = next((p for p in self.products if p['id'] == parts[1]), None)
+            if product:
+                return 200, self._product(product, expand)
+        if parts == ['prices']:
+            return 200, self._page(list(self.prices.values()), params, '/v1/prices')
+        if parts == ['events']:
+            return 200, self._page([], params, '/v1/events')
+        if parts == ['checkout', 'sessions'] and method == 'POST':
+            session_id = f'cs_bench{next(self._ids):06}'
+            form = dict(params)
+            lines = sorted(int(match[1]) for key in form if (match := re.fullmatch(r'line_items\[(\d+)\]\[price\]', key)))
+            self.sessions[session_id] = [
+                (form[f'line_items[{index}][price]'], int(form[f'line_items[{index}][quantity]'])) for index in lines
+            ]
+            return 200, {'id': session_id, 'object': 'checkout.session', 'url': f'https://checkout.example.com/{session_id}'}
+        if parts[:2] == ['checkout', 'sessions'] and len(parts) == 3:
+            customer = {'id': 'cus_bench1', 'object': 'customer', 'name': 'Bench Customer'}
+            return 200, {
+                'id': parts[2],
+                'object': 'checkout.session',
+                'currency': 'usd',
+                'customer': customer if 'customer' in expand else customer['id'],
+            }
+        if parts[:2] == ['checkout', 'sessions'] and parts[3:] == ['line_items']:
+            line_items = [
+                {
+                    'id': f'li_bench{index:05}',
+                    'object': 'item',
+                    'description': self.names[self.prices[price_id]['product']],
+                    'amount_total': self.prices[price_id]['unit_amount'] * quantity,
+                    'quantity': quantity,
+                    'price': self.prices[price_id],
+                }
+                for index, (price_id, quantity) in enumerate(self.sessions.get(parts[2], []))
+            ]
+            return 200, self._page(line_items, params, path)
+        if parts[0] == 'customers' and len(parts) == 2:
+            return 200, {'id': parts[1], 'object': 'customer', 'name': 'Bench Customer'}
+
+        return 404, {'error': {'type': 'invalid_request_error', 'message': f'No such route: {method} {path}'}}
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body go out in separate writes; don't let Nagle hold the body back
+            disable_nagle_algorithm = True
+
+            def handle_request(self, method):
+                url = urlsplit(self.path)
+                params = parse_qsl(url.query)
+                if method == 'POST':
+                    length = int(self.headers.get('Content-Length') or 0)
+                    params += parse_qsl(self.rfile.read(length).decode())
+
+                with fake._lock:
+                    endpoint = endpoint_name(method, url.path)
+                    fake.calls[endpoint] = fake.calls.get(endpoint, 0) + 1
+                time.sleep(fake.latency_ms / 1000)
+
+                status, body = fake.respond(method, url.path, params)
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                self.handle_request('GET')
+
+            def do_POST(self):
+                self.handle_request('POST')
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class Benchmark:
+    def __init__(self, fake, iterations):
+        self.fake = fake
+        self.iterations = iterations
+        self.results = []
+        self.user, _ = User.objects.get_or_create(username='bench', defaults={'email': SHIPPING['email']})
+        self.client = Client()
+        self.client.force_login(self.user)
+
+    def measure(self, view, setup, **labels):
+        """
+        Time one view. setup() runs untimed before each iteration and returns
+        the zero-argument callable that makes the request.
+        """
+        timings, stripe_calls, queries = [], [], []
+        for _ in range(self.iterations):
+            request = setup()
+            self.fake.reset_calls()
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                response = request()
+                timings.append((time.perf_counter() - started) * 1000)
+            if response.status_code >= 400:
+                raise RuntimeError(f'{view} returned {response.status_code}')
+            stripe_calls.append(self.fake.call_count())
+            queries.append(len(captured))
+
+        self.results.append({
+            'view': view,
+            **labels,
+            'iterations': self.iterations,
+            'p50_ms': round(percentile(timings, 50), 2),
+            'p95_ms': round(percentile(timings, 95), 2),
+            'stripe_calls': round(statistics.mean(stripe_calls), 2),
+            'queries': round(statistics.mean(queries), 2),
+        })
+
+    def fill_cart(self, product_ids):
+        # The bench user is logged in, so the cart lives in CartItem rows, priced as a shopper's would be
+        delete_cart_items(self.user)
+        upsert_cart_items(self.user, {product_id: 1 for product_id in product_ids}, unit_prices(product_ids), catalog_version())
+
+    def run_catalog(self, catalog_size, cart_sizes):
+        # Fresh mirror and a cold cache for every catalog size
+        Product.objects.all().delete()
+        SyncCursor.objects.all().delete()
+        self.fake.set_catalog(catalog_size)
+        full_sync()
+        cache.clear()
+
+        client = self.client
+        product_ids = [product['id'] for product in self.fake.products]
+        visits = count()
+        labels = {'catalog_size': catalog_size}
+
+        self.measure('shop_view', lambda: partial(client.get, reverse('shop')), **labels)
+        self.measure(
+            'product_view',
+            lambda: partial(client.get, reverse('product', args=[product_ids[next(visits) % catalog_size]])),
+            **labels,
+        )
+
+        for cart_size in cart_sizes:
+            if cart_size > catalog_size:
+                continue
+            cart = product_ids[:cart_size]
+            labels = {'catalog_size': catalog_size, 'cart_size': cart_size}
+
+            def with_cart(request):
+                def setup():
+                    self.fill_cart(cart)
+                    return request
+                return setup
+
+            def paid_session():
+                # A new checkout per iteration, so every success page records a fresh order
+                self.fill_cart(cart)
+                session_id = client.post(reverse('checkout'), SHIPPING)['Location'].rsplit('/', 1)[-1]
+                return partial(client.get, reverse('payment_successful'), {'session_id': session_id})
+
+            self.measure('cart_view', with_cart(partial(client.get, reverse('cart'))), **labels)
+            self.measure(
+                'update_checkout',
+                with_cart(partial(client.post, reverse('update_checkout', args=[cart[0]]), {'quantity': 2})),
+                **labels,
+            )
+            # One quantity change plus a removal, as the cart page's form sends them
+            changes = {f'quantity-{cart[0]}': 2, **({'remove': cart[-1]} if cart_size > 1 else {})}
+            self.measure('update_cart', with_cart(partial(client.post, reverse('update_cart'), changes)), **labels)
+            self.measure('checkout_view', with_cart(partial(client.post, reverse('checkout'), SHIPPING)), **labels)
+            self.measure('payment_successful', paid_session, **labels)
+
+
+def run_benchmark(catalog_sizes, cart_sizes, iterations=20, latency_ms=50):
+    """Run the sweep and return the results as a JSON-serialisable dict."""
+    with FakeStripe(latency_ms) as fake:
+        api_base, api_key = stripe.api_base, stripe.api_key
+        stripe.api_base, stripe.api_key = fake.url, 'sk_test_bench'
+        try:
+            bench = Benchmark(fake, iterations)
+            for catalog_size in catalog_sizes:
+                bench.run_catalog(catalog_size, cart_sizes)
+        finally:
+            stripe.api_base, stripe.api_key = api_base, api_key
+
+    return {
+        'config': {
+            'catalog_sizes': list(catalog_sizes),
+            'cart_sizes': list(cart_sizes),
+            'iterations': iterations,
+            'latency_ms': latency_ms,
+        },
+        'results': bench.results,
+    }
@@ -0,0 +1,63 @@
+"""
+Cache keys for catalog data.
+
+Every catalog entry, per product or rendered from many products (shop pages,
+fragments), includes catalog_version() in its key, so entries can live for a
+long time without going stale. The version is kept in the database rather
+than the cache: the webhook worker that applies catalog changes is a separate
+process, and with a per-process cache its evictions would never reach the web
+processes. Each process re-reads the version at most every
+CATALOG_VERSION_TTL seconds.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+
+from .models import SyncCursor
+
+VERSION_CURSOR = 'catalog-version'
+
+_version = {'value': None, 'read_at': 0.0}
+_version_lock = threading.Lock()
+
+
+def product_cache_key(product_id):
+    return f'catalog:{catalog_version()}:product:{product_id}'
+
+
+def missing_product_key(product_id):
+    # Neither mirrored nor known to Stripe; forgotten as soon as the catalog changes
+    return f'catalog:{catalog_version()}:missing:{product_id}'
+
+
+def _remember(version):
+    with _version_lock:
+        _version['value'], _version['read_at'] = version, time.monotonic()
+    return version
+
+
+def catalog_version():
+    if _version['value'] is not None and time.monotonic() - _version['read_at'] < settings.CATALOG_VERSION_TTL:
+        return _version['value']
+    version = SyncCursor.objects.filter(name=VERSION_CURSOR).values_list('catalog_version', flat=True).first()
+    if not version:
+        return bump_catalog_version()
+    return _remember(version)
+
+
+def bump_catalog_version():
+    # Never below the clock (in ms), so a version lost with a restored database is not reused
+    now = int(time.time() * 1000)
+    cursor = SyncCursor.objects.filter(name=VERSION_CURSOR)
+    if not cursor.update(catalog_version=Greatest(F('catalog_version') + 1, Value(now))):
+        SyncCursor.objects.get_or_create(name=VERSION_CURSOR, defaults={'catalog_version': now})
+    return _remember(cursor.values_list('catalog_version', flat=True).first())
+
+
+def evict_products(product_ids):
+    cache.delete_many([product_cache_key(product_id) for product_id in product_ids])
+    bump_catalog_version()
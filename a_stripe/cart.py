@@ -1,49 +1,308 @@
-import stripe
+from contextlib import nullcontext
+from types import MappingProxyType
+from typing import NamedTuple
 from django.conf import settings
-from .utils import get_product_details
-stripe.api_key = settings.STRIPE_TEST_KEY
+from django.db import transaction
+from .cache import catalog_version
+from .models import CartItem
+from .utils import catalog_products, get_product_details, resolve_products
+
+
+class CartFull(Exception):
+    """Adding another product would take the cart past CART_MAX_LINES."""
+
+
+class CartSnapshot(NamedTuple):
+    """Priced, read-only view of the cart. Built once per request."""
+    lines: tuple
+    total_cost: float
+    total_cents: int
+    total_quantity: int
+
+
+def read_cart_session(session):
+    """
+    The session cart as ({product_id: quantity}, {product_id: unit price in
+    cents}). Lines are stored as [quantity, cents]; carts saved before that
+    hold a bare quantity or {'quantity': n} per line, with no price.
+    """
+    quantities, prices = {}, {}
+    for product_id, item in (session.get(settings.CART_SESSION_ID) or {}).items():
+        if isinstance(item, list):
+            quantities[product_id], prices[product_id] = item
+        else:
+            quantities[product_id] = item['quantity'] if isinstance(item, dict) else item
+            prices[product_id] = None
+    return quantities, prices
+
+
+def unit_prices(product_ids):
+    """Unit prices in cents of the products on sale among product_ids, read from the mirror in one query."""
+    products = catalog_products().in_bulk(list(product_ids), field_name='stripe_id')
+    return {product_id: round(get_product_details(product)['price'] * 100) for product_id, product in products.items()}
+
+
+def load_cart_lines(user):
+    """
+    A logged-in user's cart as ({product_id: quantity}, {product_id: unit price
+    in cents}, the catalog version those prices are from), in one query on the
+    (user, product) index. The version is None unless every line shares one.
+    """
+    quantities, prices, versions = {}, {}, set()
+    for product_id, quantity, unit_amount, version in (
+        CartItem.objects.filter(user=user).order_by('id')
+        .values_list('stripe_product_id', 'quantity', 'unit_amount', 'catalog_version')
+    ):
+        quantities[product_id], prices[product_id] = quantity, unit_amount
+        versions.add(version)
+    return quantities, prices, versions.pop() if len(versions) == 1 else None
+
+
+def load_cart_items(user):
+    """A logged-in user's cart as {product_id: quantity}."""
+    return load_cart_lines(user)[0]
+
+
+def upsert_cart_items(user, quantities, prices=None, version=None):
+    """
+    Set each {product_id: quantity} in the user's cart, with its unit price
+    from prices (as of catalog version) if known, in one INSERT ... ON
+    CONFLICT DO UPDATE.
+    """
+    prices = prices or {}
+    CartItem.objects.bulk_create(
+        [
+            CartItem(
+                user=user, stripe_product_id=product_id, quantity=quantity,
+                unit_amount=prices.get(product_id), catalog_version=version if product_id in prices else None,
+            )
+            for product_id, quantity in quantities.items()
+        ],
+        update_conflicts=True,
+        unique_fields=['user', 'stripe_product_id'],
+        update_fields=['quantity', 'unit_amount', 'catalog_version', 'updated_at'],
+    )
+
+
+def delete_cart_items(user, product_ids=None):
+    """Drop the given products (or everything) from the user's cart in one DELETE."""
+    items = CartItem.objects.filter(user=user)
+    if product_ids is not None:
+        items = items.filter(stripe_product_id__in=product_ids)
+    items.delete()
+
+
+def merge_session_cart(request, user):
+    """
+    Fold the anonymous session cart into user's saved cart on login. Quantities
+    of a product in both add up (clamped to CART_MAX_QUANTITY); session lines
+    that don't fit under CART_MAX_LINES are dropped.
+    """
+    session_items, _ = read_cart_session(request.session)
+    if not session_items:
+        return
+
+    saved = load_cart_items(user)
+    room = settings.CART_MAX_LINES - len(saved)
+    merged = {}
+    for product_id, quantity in session_items.items():
+        if product_id in saved:
+            merged[product_id] = min(saved[product_id] + quantity, settings.CART_MAX_QUANTITY)
+        elif room > 0:
+            merged[product_id] = min(quantity, settings.CART_MAX_QUANTITY)
+            room -= 1
+    if merged:
+        # Stored unpriced; the cart prices them all (in one query) when next read
+        upsert_cart_items(user, merged)
+
+    del request.session[settings.CART_SESSION_ID]
+    request.session.pop(settings.CART_VERSION_SESSION_ID, None)
+    request.__dict__.pop('_cart_lines', None)
+    request.__dict__.pop('_cart_snapshot', None)
+
 
 class Cart:
+    """
+    The cart as {product_id: quantity} in cart_session: CartItem rows for a
+    logged-in user, the session for everyone else (merged in on login).
+
+    Each line is stored with its unit price (unit_prices) and the catalog
+    version that price is from, so the running total is summed from the
+    lines and a change only prices the lines it touches. Once the catalog has
+    changed, every line is priced again from the mirror in one query; those
+    prices are stored with the next change, so reading never writes.
+    """
+
     def __init__(self, request):
+        self.request = request
         self.session = request.session
-        cart_session = self.session.get(settings.CART_SESSION_ID)
-        if not cart_session:
-            cart_session = self.session[settings.CART_SESSION_ID] = {}
-        self.cart_session = cart_session
+        user = getattr(request, 'user', None)
+        self.user = user if user is not None and user.is_authenticated else None
+        if self.user:
+            # Loaded once per request and shared by every Cart built for it
+            lines = getattr(request, '_cart_lines', None)
+            if lines is None:
+                items, prices, version = load_cart_lines(self.user)
+                lines = request._cart_lines = (items, prices, {'priced': version, 'stored': version})
+            self.cart_session, self.unit_prices, self.versions = lines
+        else:
+            # Only written back to the session on a change, so merely reading the cart never writes the session.
+            self.cart_session, self.unit_prices = read_cart_session(self.session)
+            version = self.session.get(settings.CART_VERSION_SESSION_ID)
+            self.versions = {'priced': version, 'stored': version}
 
-    
-    def __iter__(self):
-        for product_id, item in self.cart_session.items():
-            product = stripe.Product.retrieve(product_id)
-            product_details = get_product_details(product)
+    @property
+    def snapshot(self):
+        # Stored on the request so every Cart built for it (views, context processor) shares one pricing pass.
+        snapshot = getattr(self.request, '_cart_snapshot', None)
+        if snapshot is None:
+            snapshot = self.request._cart_snapshot = self._build_snapshot()
+        return snapshot
+
+    @property
+    def running_total(self):
+        """
+        The total without pricing every line: the snapshot's if this request
+        built one, else the sum of the lines at their prices as of the
+        current catalog version.
+        """
+        snapshot = getattr(self.request, '_cart_snapshot', None)
+        if snapshot is not None:
+            return snapshot.total_cost
+        self._reprice()
+        return sum((self.unit_prices[product_id] or 0) * quantity for product_id, quantity in self.cart_session.items()) / 100
 
-            yield {
+    def _reprice(self, extra_ids=()):
+        """
+        Price every line again if the catalog changed since its prices were
+        recorded, along with extra_ids, in one query. Returns the extra prices.
+        """
+        version = catalog_version()
+        if self.versions['priced'] == version:
+            return unit_prices(extra_ids) if extra_ids else {}
+        prices = unit_prices([*self.cart_session, *extra_ids])
+        self.unit_prices.update({product_id: prices.get(product_id) for product_id in self.cart_session})
+        self.versions['priced'] = version
+        return prices
+
+    def _build_snapshot(self):
+        products = resolve_products(self.cart_session)
+        lines = []
+        for product_id, quantity in self.cart_session.items():
+            if product_id not in products:
+                continue
+            product_details = get_product_details(products[product_id])
+
+            lines.append(MappingProxyType({
                 'id': product_id,
                 'image': product_details['image'],
                 'name': product_details['name'],
                 'price': product_details['price'],
-                'quantity': item['quantity'],
-                'total_price': product_details['price'] * item['quantity']
-            }
-            
+                'price_id': product_details['price_id'],
+                'quantity': quantity,
+                'total_price': product_details['price'] * quantity
+            }))
+
+        total_cents = sum(round(line['price'] * 100) * line['quantity'] for line in lines)
+        return CartSnapshot(
+            lines=tuple(lines),
+            total_cost=total_cents / 100,
+            total_cents=total_cents,
+            total_quantity=sum(line['quantity'] for line in lines),
+        )
+
+    def invalidate(self):
+        self.request.__dict__.pop('_cart_snapshot', None)
+
+    def __iter__(self):
+        return iter(self.snapshot.lines)
+
     def __len__(self):
-        return sum(item['quantity'] for item in self.cart_session.values())
+        return sum(self.cart_session.values())
 
-    def save(self):
-        self.session.modified = True
+    def update(self, quantities=None, removed=()):
+        """
+        Apply several changes at once, all or none of them: set each
+        {product_id: quantity} (clamped to 1..CART_MAX_QUANTITY) and drop each
+        removed product. Raises CartFull, changing nothing, if the new lines
+        don't fit under CART_MAX_LINES. Returns the ids of the lines that changed.
+        """
+        removed = [product_id for product_id in dict.fromkeys(removed) if product_id in self.cart_session]
+        changed = {}
+        for product_id, quantity in (quantities or {}).items():
+            quantity = min(max(int(quantity), 1), settings.CART_MAX_QUANTITY)
+            if product_id not in removed and self.cart_session.get(product_id) != quantity:
+                changed[product_id] = quantity
+        if not changed and not removed:
+            return set()
+
+        new_lines = [product_id for product_id in changed if product_id not in self.cart_session]
+        if new_lines and len(self.cart_session) - len(removed) + len(new_lines) > settings.CART_MAX_LINES:
+            raise CartFull(f'A cart can hold at most {settings.CART_MAX_LINES} different products.')
+
+        self._write(changed, removed)
+        return set(changed) | set(removed)
+
+    def _write(self, changed, removed):
+        # Only the changed lines are priced, unless the catalog changed and every line is
+        prices = self._reprice(changed)
+        prices = {product_id: prices.get(product_id) for product_id in changed}
+        version = self.versions['priced']
+        # Lines priced again but not changed are stored too, with the change
+        written = dict(changed)
+        if self.versions['stored'] != version:
+            written.update({
+                product_id: quantity for product_id, quantity in self.cart_session.items()
+                if product_id not in removed and product_id not in changed
+            })
+            prices.update({product_id: self.unit_prices[product_id] for product_id in written if product_id not in prices})
+
+        # Store first, then mirror in cart_session, so a failed write leaves the cart as it was
+        if self.user:
+            with transaction.atomic() if written and removed else nullcontext():
+                if written:
+                    upsert_cart_items(self.user, written, prices, version)
+                if removed:
+                    delete_cart_items(self.user, removed)
+        for product_id in removed:
+            del self.cart_session[product_id]
+            self.unit_prices.pop(product_id, None)
+        self.cart_session.update(changed)
+        self.unit_prices.update(prices)
+        self.versions['stored'] = version
+        if not self.user:
+            # Assigning marks the session modified; nothing else does, so unchanged carts are never written
+            self.session[settings.CART_SESSION_ID] = {
+                product_id: [quantity, self.unit_prices[product_id]] for product_id, quantity in self.cart_session.items()
+            }
+            self.session[settings.CART_VERSION_SESSION_ID] = version
+        self.invalidate()
+
+    def line_total(self, product_id):
+        """One line's total at its price as of the current catalog version."""
+        self._reprice()
+        return (self.unit_prices.get(product_id) or 0) * self.cart_session.get(product_id, 0) / 100
 
     def add(self, product_id, quantity=1):
-        self.cart_session[product_id] = {'quantity': quantity}
-        self.save()
-    
+        """Set product_id's quantity (clamped to 1..CART_MAX_QUANTITY). Raises CartFull for one line too many."""
+        self.update({product_id: quantity})
+
     def remove(self, product_id):
-        if product_id in self.cart_session:
-            del self.cart_session[product_id]
-            self.save()
-    
+        self.update(removed=[product_id])
+
+    def clear(self):
+        if self.user:
+            if self.cart_session:
+                delete_cart_items(self.user)
+        else:
+            self.session.pop(settings.CART_SESSION_ID, None)
+            self.session.pop(settings.CART_VERSION_SESSION_ID, None)
+        self.cart_session.clear()
+        self.unit_prices.clear()
+        self.invalidate()
+
     def get_total_cost(self):
-        return sum(product_item['total_price'] for product_item in self)
-    
+        return self.snapshot.total_cost
 
     def get_total_quantity(self):
-        return sum(item['quantity'] for item in self.cart_session.values())
\ No newline at end of file
+        return self.snapshot.total_quantity
@@ -0,0 +1,133 @@
+"""
+The one place Stripe is configured for the project.
+
+configure() (called from AStripeConfig.ready) sets the API key and installs a
+single HTTP client for every stripe.* call: one requests session whose
+keep-alive connection pool is shared by all threads, explicit connect/read
+timeouts from settings, a process-wide cap of STRIPE_MAX_CONCURRENCY requests
+in flight, and per-endpoint call counts and latency histograms.
+"""
+from collections import defaultdict
+from contextvars import ContextVar
+import logging
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+import stripe
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (ms) of the latency histogram buckets; the last one catches everything slower.
+LATENCY_BUCKETS_MS = (25, 50, 100, 250, 500, 1000, 2500, 5000, float('inf'))
+
+# Object ids (prod_Nx81..., cs_test_a1B2...) always carry a digit or capital; resource names like line_items don't.
+STRIPE_ID_RE = re.compile(r'/[a-z]+_(?:[a-z]+_)?[A-Za-z0-9]*[A-Z0-9][A-Za-z0-9]*(?=/|$)')
+
+
+def endpoint_name(method, url):
+    """'GET /v1/products/{id}' for https://api.stripe.com/v1/products/prod_123?expand[]=..."""
+    path = STRIPE_ID_RE.sub('/{id}', urlsplit(url).path)
+    return f'{method.upper()} {path}'
+
+
+class StripeMetrics:
+    """Process-wide call counts, error counts and latency histograms per endpoint."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._endpoints = defaultdict(lambda: {
+                'count': 0,
+                'errors': 0,
+                'total_ms': 0.0,
+                'buckets': [0] * len(LATENCY_BUCKETS_MS),
+            })
+
+    def record(self, endpoint, elapsed_ms, error=False):
+        with self._lock:
+            stats = self._endpoints[endpoint]
+            stats['count'] += 1
+            stats['errors'] += int(error)
+            stats['total_ms'] += elapsed_ms
+            for index, upper in enumerate(LATENCY_BUCKETS_MS):
+                if elapsed_ms <= upper:
+                    stats['buckets'][index] += 1
+                    break
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                endpoint: {
+                    'count': stats['count'],
+                    'errors': stats['errors'],
+                    'total_ms': round(stats['total_ms'], 1),
+                    'buckets': dict(zip(LATENCY_BUCKETS_MS, stats['buckets'])),
+                }
+                for endpoint, stats in self._endpoints.items()
+            }
+
+
+metrics = StripeMetrics()
+
+# Set per request by a_core.middleware.ServerTimingMiddleware: called with (endpoint, elapsed_ms, error).
+request_recorder = ContextVar('stripe_request_recorder', default=None)
+
+
+class StripeHTTPClient(stripe.RequestsClient):
+    """RequestsClient that times every request it makes and caps how many run at once."""
+
+    def __init__(self, *args, max_concurrency=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Every Stripe request goes through here, whether inline, on the fetch pool or from an async view
+        self._slots = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+
+    def request(self, method, url, headers, post_data=None):
+        if self._slots is None:
+            return self._timed_request(method, url, headers, post_data)
+        with self._slots:
+            return self._timed_request(method, url, headers, post_data)
+
+    def _timed_request(self, method, url, headers, post_data):
+        endpoint = endpoint_name(method, url)
+        started = time.perf_counter()
+        error = True
+        try:
+            response = super().request(method, url, headers, post_data)
+            error = response[1] >= 400
+            return response
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            metrics.record(endpoint, elapsed_ms, error)
+            recorder = request_recorder.get()
+            if recorder:
+                recorder(endpoint, elapsed_ms, error)
+            logger.debug('stripe %s %.1fms%s', endpoint, elapsed_ms, ' (error)' if error else '')
+
+
+def build_session():
+    # One pool per host, big enough for every thread that may call Stripe at once.
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=2,
+        pool_maxsize=settings.STRIPE_MAX_CONCURRENCY,
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def configure():
+    stripe.api_key = settings.STRIPE_TEST_KEY
+    stripe.max_network_retries = settings.STRIPE_MAX_NETWORK_RETRIES
+    stripe.default_http_client = StripeHTTPClient(
+        session=build_session(),
+        timeout=(settings.STRIPE_CONNECT_TIMEOUT, settings.STRIPE_READ_TIMEOUT),
+        max_concurrency=settings.STRIPE_MAX_CONCURRENCY,
+    )
@@ -1,5 +1,33 @@
 from .cart import Cart
 
+
+class LazyCart:
+    """
+    Cart handed to every template. The header badge only needs len(), which
+    costs at most the one cart query; the cart is priced the first time a
+    template iterates it or asks for a total.
+    """
+
+    def __init__(self, request):
+        self._request = request
+        self._cart = None
+
+    def _get_cart(self):
+        if self._cart is None:
+            self._cart = Cart(self._request)
+        return self._cart
+
+    def __len__(self):
+        return len(self._get_cart())
+
+    def __iter__(self):
+        return iter(self._get_cart())
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._get_cart(), name)
+
+
 def cart(request):
-    cart = Cart(request)
-    return {'cart': Cart(request)}
\ No newline at end of file
+    return {'cart': LazyCart(request)}
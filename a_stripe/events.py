@@ -0,0 +1,137 @@
+"""
+Durable queue for Stripe webhook events.
+
+The webhook only verifies the signature and stores the event, keyed by its
+Stripe id so redeliveries are ignored. The process_stripe_events command
+claims pending events in batches and runs their handlers, retrying failures
+with exponential backoff.
+
+A handler may have a fetch step (FETCHERS) that makes its Stripe calls before
+the handler's transaction opens, so no database lock is held while waiting on
+Stripe. Whatever it returns is passed to the handler.
+"""
+from datetime import timedelta
+import logging
+import uuid
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+import stripe
+
+from .models import CheckoutSession, StripeEvent, UserPayment
+from .orders import orders_recorded, record_orders
+from .sync import CATALOG_EVENT_TYPES, apply_event, fetch_event_parents
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 8
+BACKOFF_BASE_SECONDS = 30
+BACKOFF_MAX_SECONDS = 60 * 60
+# A claimed event whose worker died is handed out again after this long.
+LEASE_SECONDS = 5 * 60
+
+
+def fetch_checkout_line_items(event):
+    """The paid session's line items, if its order still has to be recorded."""
+    checkout_session_id = event['data']['object']['id']
+    checkout = CheckoutSession.objects.select_related('shipping_info').filter(checkout_id=checkout_session_id).first()
+    user = checkout.shipping_info.user if checkout and checkout.shipping_info else None
+    if user is None or orders_recorded(checkout_session_id):
+        return None
+    return user, stripe.checkout.Session.list_line_items(checkout_session_id, limit=100).data
+
+
+def handle_checkout_completed(event, order=None):
+    session = event['data']['object']
+    checkout_session_id = session['id']
+    UserPayment.objects.filter(stripe_checkout_id=checkout_session_id).update(has_paid=True)
+    CheckoutSession.objects.filter(checkout_id=checkout_session_id).update(has_paid=True)
+
+    # Record the order here too, in case the buyer never makes it back to the success page.
+    if order is not None:
+        user, line_items = order
+        record_orders(user, checkout_session_id, session.get('currency', ''), line_items)
+
+
+FETCHERS = {
+    'checkout.session.completed': fetch_checkout_line_items,
+    **{event_type: fetch_event_parents for event_type in CATALOG_EVENT_TYPES},
+}
+
+HANDLERS = {
+    'checkout.session.completed': handle_checkout_completed,
+    **{event_type: apply_event for event_type in CATALOG_EVENT_TYPES},
+}
+
+
+def enqueue(event):
+    """Store a verified event. Returns False if this event id was already queued."""
+    try:
+        with transaction.atomic():
+            StripeEvent.objects.create(event_id=event['id'], type=event['type'], payload=event)
+    except IntegrityError:
+        return False
+    return True
+
+
+def backoff(attempts):
+    return timedelta(seconds=min(BACKOFF_BASE_SECONDS * 2 ** (attempts - 1), BACKOFF_MAX_SECONDS))
+
+
+def claim_batch(batch_size):
+    """Atomically take up to batch_size due events for this worker."""
+    now = timezone.now()
+    due = (
+        Q(status=StripeEvent.PENDING, available_at__lte=now)
+        | Q(status=StripeEvent.PROCESSING, locked_at__lt=now - timedelta(seconds=LEASE_SECONDS))
+    )
+    candidates = list(
+        StripeEvent.objects.filter(due).order_by('available_at', 'id').values_list('id', flat=True)[:batch_size]
+    )
+    if not candidates:
+        return []
+
+    # Re-checking `due` in the UPDATE means two workers can never claim the same row.
+    token = uuid.uuid4().hex
+    StripeEvent.objects.filter(due, id__in=candidates).update(
+        status=StripeEvent.PROCESSING,
+        locked_by=token,
+        locked_at=now,
+        attempts=F('attempts') + 1,
+    )
+    return list(StripeEvent.objects.filter(locked_by=token, status=StripeEvent.PROCESSING).order_by('available_at', 'id'))
+
+
+def process_event(stripe_event):
+    handler = HANDLERS.get(stripe_event.type)
+    fetch = FETCHERS.get(stripe_event.type)
+    try:
+        if handler:
+            fetched = fetch(stripe_event.payload) if fetch else None
+            with transaction.atomic():
+                handler(stripe_event.payload, fetched)
+    except Exception as e:
+        logger.exception('Stripe event %s failed (attempt %s)', stripe_event.event_id, stripe_event.attempts)
+        stripe_event.last_error = repr(e)
+        if stripe_event.attempts >= MAX_ATTEMPTS:
+            stripe_event.status = StripeEvent.FAILED
+        else:
+            stripe_event.status = StripeEvent.PENDING
+            stripe_event.available_at = timezone.now() + backoff(stripe_event.attempts)
+        stripe_event.save(update_fields=['status', 'available_at', 'last_error'])
+        return False
+
+    stripe_event.status = StripeEvent.DONE
+    stripe_event.processed_at = timezone.now()
+    stripe_event.last_error = ''
+    stripe_event.save(update_fields=['status', 'processed_at', 'last_error'])
+    return True
+
+
+def process_batch(batch_size=50):
+    """Claim and process one batch. Returns how many events were claimed."""
+    batch = claim_batch(batch_size)
+    for stripe_event in batch:
+        process_event(stripe_event)
+    return len(batch)
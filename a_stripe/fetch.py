@@ -0,0 +1,47 @@
+"""
+Bounded, process-wide thread pool for running blocking Stripe calls side by side.
+
+Under WSGI each request still has one thread, but independent Stripe lookups
+can overlap on this pool. The pool is STRIPE_MAX_CONCURRENCY threads; the
+process-wide cap on Stripe requests in flight (including single calls made
+inline and those from async views) is enforced by a_stripe.client.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+from functools import lru_cache
+import time
+
+from django.conf import settings
+
+
+@lru_cache(maxsize=None)
+def get_executor():
+    return ThreadPoolExecutor(max_workers=settings.STRIPE_MAX_CONCURRENCY, thread_name_prefix='stripe-fetch')
+
+
+def fetch_all(calls, timeout=None):
+    """
+    Run zero-argument callables (e.g. functools.partial) on the shared pool.
+
+    Results come back in the order the calls were given. Every call has to
+    finish within timeout seconds (default STRIPE_FETCH_TIMEOUT) of the batch
+    starting, otherwise the unfinished ones are cancelled and TimeoutError is
+    raised. The first exception raised by a call is re-raised here.
+    """
+    calls = list(calls)
+    if len(calls) <= 1:
+        return [call() for call in calls]
+
+    if timeout is None:
+        timeout = settings.STRIPE_FETCH_TIMEOUT
+    deadline = time.monotonic() + timeout
+
+    # Each call runs in a copy of the caller's context, so per-request instrumentation follows it onto the pool
+    futures = [get_executor().submit(contextvars.copy_context().run, call) for call in calls]
+    try:
+        return [future.result(timeout=max(deadline - time.monotonic(), 0)) for future in futures]
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from a_stripe.orders import backfill_orders
+
+
+class Command(BaseCommand):
+    help = 'Create Order headers for past order lines recorded before orders existed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Lines to group per transaction')
+
+    def handle(self, *args, **options):
+        created = backfill_orders(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Created {created} orders'))
@@ -0,0 +1,42 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from a_stripe.bench import run_benchmark
+
+
+def sizes(value):
+    return [int(size) for size in value.split(',') if size]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the storefront views against a local fake Stripe server and print the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--catalog-sizes', type=sizes, default=[10, 100, 1000], help='Comma-separated catalog sizes')
+        parser.add_argument('--cart-sizes', type=sizes, default=[1, 10, 50], help='Comma-separated cart sizes')
+        parser.add_argument('--iterations', type=int, default=20, help='Requests per view and size')
+        parser.add_argument('--latency', type=float, default=50, help='Milliseconds the fake Stripe waits per call')
+        parser.add_argument('--output', help='Write the JSON here instead of stdout')
+
+    def handle(self, *args, **options):
+        # Never touch the real database: run against a throwaway test database
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            report = run_benchmark(
+                options['catalog_sizes'],
+                options['cart_sizes'],
+                iterations=options['iterations'],
+                latency_ms=options['latency'],
+            )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+            self.stdout.write(self.style.SUCCESS(f"Wrote {len(report['results'])} results to {options['output']}"))
+        else:
+            self.stdout.write(output)
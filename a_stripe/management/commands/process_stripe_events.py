@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from a_stripe.events import process_batch
+
+
+class Command(BaseCommand):
+    help = 'Process queued Stripe webhook events'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50)
+        parser.add_argument('--once', action='store_true', help='Drain the queue once and exit')
+        parser.add_argument('--sleep', type=float, default=2, help='Seconds to wait when the queue is empty')
+
+    def handle(self, *args, **options):
+        while True:
+            claimed = process_batch(options['batch_size'])
+            if claimed:
+                self.stdout.write(f'Processed {claimed} events')
+                continue
+            if options['once']:
+                break
+            time.sleep(options['sleep'])
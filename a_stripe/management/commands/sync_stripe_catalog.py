@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from a_stripe.sync import delta_sync, full_sync
+
+
+class Command(BaseCommand):
+    help = 'Mirror Stripe products and prices into the local catalog tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='Re-page the whole catalog before applying deltas')
+        parser.add_argument('--interval', type=int, default=0, help='Keep running delta syncs every N seconds')
+
+    def handle(self, *args, **options):
+        if options['full']:
+            count = full_sync()
+            self.stdout.write(self.style.SUCCESS(f'Full sync mirrored {count} products'))
+
+        while True:
+            applied = delta_sync()
+            self.stdout.write(f'Delta sync applied {applied} events')
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
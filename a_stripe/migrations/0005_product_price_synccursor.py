@@ -0,0 +1,71 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_stripe', '0004_pastorder'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Price',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stripe_id', models.CharField(max_length=255, unique=True)),
+                ('unit_amount', models.IntegerField(blank=True, null=True)),
+                ('currency', models.CharField(max_length=3)),
+                ('active', models.BooleanField(default=True)),
+                ('stripe_created', models.DateTimeField(blank=True, null=True)),
+                ('synced_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SyncCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('last_event_created', models.IntegerField(default=0)),
+                ('last_full_sync', models.DateTimeField(blank=True, null=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Product',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stripe_id', models.CharField(max_length=255, unique=True)),
+                ('name', models.CharField(max_length=255)),
+                ('description', models.TextField(blank=True, default='')),
+                ('image', models.URLField(blank=True, default='', max_length=2048)),
+                ('category', models.CharField(blank=True, default='', max_length=100)),
+                ('sku', models.CharField(blank=True, default='', max_length=100)),
+                ('metadata', models.JSONField(blank=True, default=dict)),
+                ('active', models.BooleanField(default=True)),
+                ('stripe_default_price', models.CharField(blank=True, default='', max_length=255)),
+                ('stripe_created', models.DateTimeField(blank=True, null=True)),
+                ('synced_at', models.DateTimeField(auto_now=True)),
+                ('default_price', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='a_stripe.price')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='price',
+            name='product',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='prices', to='a_stripe.product'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['active', 'category', '-stripe_created'], name='product_shop_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['sku'], name='product_sku_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='price',
+            index=models.Index(fields=['product', 'active', '-stripe_created'], name='price_product_idx'),
+        ),
+    ]
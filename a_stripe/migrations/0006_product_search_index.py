@@ -0,0 +1,70 @@
+from django.db import migrations, OperationalError
+
+# External-content FTS5 index over the product mirror. The triggers keep it in
+# step with every insert/update/delete, including the ones made by the sync engine.
+CREATE_SQL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS a_stripe_product_fts USING fts5(
+        name, sku, description,
+        content='a_stripe_product', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS a_stripe_product_fts_ai AFTER INSERT ON a_stripe_product BEGIN
+        INSERT INTO a_stripe_product_fts(rowid, name, sku, description)
+        VALUES (new.id, new.name, new.sku, new.description);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS a_stripe_product_fts_ad AFTER DELETE ON a_stripe_product BEGIN
+        INSERT INTO a_stripe_product_fts(a_stripe_product_fts, rowid, name, sku, description)
+        VALUES ('delete', old.id, old.name, old.sku, old.description);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS a_stripe_product_fts_au AFTER UPDATE ON a_stripe_product BEGIN
+        INSERT INTO a_stripe_product_fts(a_stripe_product_fts, rowid, name, sku, description)
+        VALUES ('delete', old.id, old.name, old.sku, old.description);
+        INSERT INTO a_stripe_product_fts(rowid, name, sku, description)
+        VALUES (new.id, new.name, new.sku, new.description);
+    END
+    """,
+    "INSERT INTO a_stripe_product_fts(a_stripe_product_fts) VALUES ('rebuild')",
+]
+
+DROP_SQL = [
+    "DROP TRIGGER IF EXISTS a_stripe_product_fts_ai",
+    "DROP TRIGGER IF EXISTS a_stripe_product_fts_ad",
+    "DROP TRIGGER IF EXISTS a_stripe_product_fts_au",
+    "DROP TABLE IF EXISTS a_stripe_product_fts",
+]
+
+
+def create_search_index(apps, schema_editor):
+    # Other databases (or SQLite builds without FTS5) use the icontains fallback in a_stripe.search.
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    try:
+        for sql in CREATE_SQL:
+            schema_editor.execute(sql)
+    except OperationalError:
+        pass
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for sql in DROP_SQL:
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("a_stripe", "0005_product_price_synccursor"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:42
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def drop_duplicate_orders(apps, schema_editor):
+    # Reloads of the success page used to insert every line again; keep the first copy.
+    PastOrder = apps.get_model('a_stripe', 'PastOrder')
+    keep = (
+        PastOrder.objects.exclude(stripe_checkout_id='')
+        .values('stripe_checkout_id', 'stripe_product_id')
+        .annotate(first_id=Min('id'))
+        .values_list('first_id', flat=True)
+    )
+    PastOrder.objects.exclude(stripe_checkout_id='').exclude(id__in=list(keep)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_stripe', '0007_stripeevent'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_duplicate_orders, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='pastorder',
+            constraint=models.UniqueConstraint(condition=models.Q(('stripe_checkout_id', ''), _negated=True), fields=('stripe_checkout_id', 'stripe_product_id'), name='pastorder_checkout_product_uniq'),
+        ),
+    ]
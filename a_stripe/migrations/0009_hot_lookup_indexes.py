@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:43
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_stripe', '0008_pastorder_unique_line'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='checkoutsession',
+            name='checkout_id',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='userpayment',
+            name='stripe_checkout_id',
+            field=models.CharField(db_index=True, max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name='pastorder',
+            index=models.Index(fields=['user', '-created_at', '-id'], name='pastorder_user_recent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pastorder',
+            index=models.Index(fields=['stripe_checkout_id'], name='pastorder_checkout_idx'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:34
+
+from importlib import import_module
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F
+
+search_index = import_module('a_stripe.migrations.0006_product_search_index')
+
+
+def fill_missing_created(apps, schema_editor):
+    # The shop sort key can't be null any more; fall back to when the row was mirrored
+    Product = apps.get_model('a_stripe', 'Product')
+    Product.objects.filter(stripe_created__isnull=True).update(stripe_created=F('synced_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_stripe', '0011_cartitem'),
+    ]
+
+    # Altering stripe_created makes SQLite rebuild a_stripe_product, which drops the
+    # search index triggers from 0006; they are put back (and the index rebuilt) at the end.
+    operations = [
+        migrations.RunPython(fill_missing_created, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='product',
+            name='product_shop_idx',
+        ),
+        migrations.AlterField(
+            model_name='product',
+            name='stripe_created',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(('active', True), ('default_price__isnull', False)), fields=['category', '-stripe_created', '-id'], name='product_shop_idx'),
+        ),
+        migrations.RunPython(search_index.create_search_index, migrations.RunPython.noop),
+    ]
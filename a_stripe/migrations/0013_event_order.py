@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:39
+
+from importlib import import_module
+
+from django.db import migrations, models
+
+search_index = import_module('a_stripe.migrations.0006_product_search_index')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_stripe', '0012_shop_sort_index'),
+    ]
+
+    # Adding a column with a default rebuilds a_stripe_product on SQLite, dropping the search triggers
+    operations = [
+        migrations.AddField(
+            model_name='price',
+            name='last_event_created',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='last_event_created',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(search_index.create_search_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_stripe', '0013_event_order'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='synccursor',
+            name='catalog_version',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_stripe', '0014_synccursor_catalog_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cartitem',
+            name='unit_amount',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_stripe', '0015_cartitem_unit_amount'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cartitem',
+            name='catalog_version',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -1,12 +1,13 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 # Create your models here.
 
 class UserPayment(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     stripe_customer_id = models.CharField(max_length=255)
-    stripe_checkout_id = models.CharField(max_length=255)
+    stripe_checkout_id = models.CharField(max_length=255, db_index=True)
     stripe_product_id = models.CharField(max_length=255)
     product_name = models.CharField(max_length=255)
     price = models.DecimalField(max_digits=10, decimal_places=2)
@@ -33,7 +34,7 @@ class ShippingInfo(models.Model):
         return f" {self.first_name} {self.last_name}"
 
 class CheckoutSession(models.Model):
-    checkout_id = models.CharField(max_length=255)
+    checkout_id = models.CharField(max_length=255, unique=True)
     shipping_info = models.ForeignKey(ShippingInfo, on_delete=models.SET_NULL, blank=True, null=True)
     created = models.DateTimeField(auto_now_add=True)
     has_paid = models.BooleanField(default=False)
@@ -47,8 +48,37 @@ class CheckoutSession(models.Model):
         return f'{self.checkout_id} - {self.shipping_info} - ${self.total_cost} - {date} - Paid: {self.has_paid}'
 
 
+class Order(models.Model):
+    """One paid checkout. Its PastOrder rows are the line items; the totals are kept here."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='orders')
+    # Indexed on its own too: the partial unique constraint can't serve plain lookups
+    stripe_checkout_id = models.CharField(max_length=255, blank=True, default='', db_index=True)
+    total = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    item_count = models.IntegerField(default=0)
+    currency = models.CharField(max_length=3, blank=True, default='')
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # Profile order history: newest first, id breaks ties
+            models.Index(fields=['user', '-created_at', '-id'], name='order_user_recent_idx'),
+        ]
+        constraints = [
+            # Lines recorded before orders existed may have no checkout id
+            models.UniqueConstraint(
+                fields=['stripe_checkout_id'],
+                condition=~models.Q(stripe_checkout_id=''),
+                name='order_checkout_uniq',
+            ),
+        ]
+
+    def __str__(self):
+        return f"Order {self.id} - {self.user.username} - {self.total} {self.currency}"
+
+
 class PastOrder(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, blank=True, null=True, related_name='items')
     stripe_checkout_id = models.CharField(max_length=255)
     stripe_product_id = models.CharField(max_length=255)
     product_name = models.CharField(max_length=255)
@@ -58,5 +88,141 @@ class PastOrder(models.Model):
     product_image = models.URLField(blank=True, null=True)  # Store the product image URL if available
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # Profile order history: newest first, id breaks ties
+            models.Index(fields=['user', '-created_at', '-id'], name='pastorder_user_recent_idx'),
+            # The partial unique constraint below can't serve plain checkout id lookups
+            models.Index(fields=['stripe_checkout_id'], name='pastorder_checkout_idx'),
+        ]
+        constraints = [
+            # One row per product per paid checkout, however often the session is recorded.
+            models.UniqueConstraint(
+                fields=['stripe_checkout_id', 'stripe_product_id'],
+                condition=~models.Q(stripe_checkout_id=''),
+                name='pastorder_checkout_product_uniq',
+            ),
+        ]
+
     def __str__(self):
         return f"Order: {self.product_name} - {self.user.username} - {self.price}"
+
+
+class CartItem(models.Model):
+    """A line of a logged-in user's cart. Anonymous carts stay in the session until login."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='cart_items')
+    stripe_product_id = models.CharField(max_length=255)
+    quantity = models.PositiveIntegerField(default=1)
+    # Unit price in cents as of catalog_version (see a_stripe.cache); the running total is summed from these
+    unit_amount = models.PositiveIntegerField(blank=True, null=True)
+    catalog_version = models.BigIntegerField(blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            # Also the index every cart read goes through (user is its leading column)
+            models.UniqueConstraint(fields=['user', 'stripe_product_id'], name='cartitem_user_product_uniq'),
+        ]
+
+    def __str__(self):
+        return f'{self.user.username} - {self.stripe_product_id} x {self.quantity}'
+
+
+class Product(models.Model):
+    """Local mirror of a Stripe product, kept current by a_stripe.sync."""
+    stripe_id = models.CharField(max_length=255, unique=True)
+    name = models.CharField(max_length=255)
+    description = models.TextField(blank=True, default='')
+    image = models.URLField(max_length=2048, blank=True, default='')
+    category = models.CharField(max_length=100, blank=True, default='')
+    sku = models.CharField(max_length=100, blank=True, default='')
+    metadata = models.JSONField(default=dict, blank=True)
+    active = models.BooleanField(default=True)
+    stripe_default_price = models.CharField(max_length=255, blank=True, default='')
+    default_price = models.ForeignKey('Price', on_delete=models.SET_NULL, blank=True, null=True, related_name='+')
+    # Never null: it is the shop grid's sort key
+    stripe_created = models.DateTimeField(default=timezone.now)
+    # Stripe timestamp of the newest event (or full sync) applied to this row; older events are skipped
+    last_event_created = models.IntegerField(default=0)
+    synced_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # Shop grid: products for sale in a category, newest first, id breaks ties
+            models.Index(
+                fields=['category', '-stripe_created', '-id'],
+                condition=models.Q(active=True, default_price__isnull=False),
+                name='product_shop_idx',
+            ),
+            models.Index(fields=['sku'], name='product_sku_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.name} ({self.stripe_id})'
+
+
+class Price(models.Model):
+    """Local mirror of a Stripe price. unit_amount is stored in cents."""
+    stripe_id = models.CharField(max_length=255, unique=True)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='prices')
+    unit_amount = models.IntegerField(blank=True, null=True)
+    currency = models.CharField(max_length=3)
+    active = models.BooleanField(default=True)
+    stripe_created = models.DateTimeField(blank=True, null=True)
+    last_event_created = models.IntegerField(default=0)
+    synced_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['product', 'active', '-stripe_created'], name='price_product_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.stripe_id} - {self.unit_amount} {self.currency}'
+
+
+class SyncCursor(models.Model):
+    """Where the last catalog sync stopped, as a Stripe event timestamp."""
+    name = models.CharField(max_length=100, unique=True)
+    last_event_created = models.IntegerField(default=0)
+    last_full_sync = models.DateTimeField(blank=True, null=True)
+    # Bumped on every catalog change, see a_stripe.cache
+    catalog_version = models.BigIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.name} - {self.last_event_created}'
+
+
+class StripeEvent(models.Model):
+    """Webhook event waiting for (or done with) the process_stripe_events worker."""
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (PROCESSING, 'Processing'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    event_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=100)
+    payload = models.JSONField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=64, blank=True, default='')
+    locked_at = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'available_at'], name='stripeevent_queue_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.event_id} - {self.type} - {self.status}'
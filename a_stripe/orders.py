@@ -0,0 +1,104 @@
+"""
+Recording paid checkout sessions as orders.
+
+Both the success redirect and the checkout.session.completed webhook call
+record_orders(); whichever runs first writes the Order header and its
+PastOrder lines, every later call stops at one indexed existence check. The
+unique constraints on the checkout id back this up when two of them race.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+
+from .models import Order, PastOrder
+
+
+def orders_recorded(checkout_session_id):
+    return Order.objects.filter(stripe_checkout_id=checkout_session_id).exists()
+
+
+def record_orders(user, checkout_session_id, currency, line_items):
+    """Save the session as one Order with its line items. Returns False if already recorded."""
+    if orders_recorded(checkout_session_id):
+        return False
+
+    # One line per product (the unique constraint); a product bought at two prices is merged,
+    # so the Order header always adds up to the lines written under it.
+    lines = {}
+    for line_item in line_items:
+        product_id = line_item.price.product
+        line = lines.get(product_id)
+        if line is None:
+            lines[product_id] = PastOrder(
+                user=user,
+                stripe_checkout_id=checkout_session_id,
+                stripe_product_id=product_id,
+                product_name=line_item.description,
+                price=Decimal(line_item.amount_total) / 100,  # Stripe amount is in cents
+                currency=currency,
+                quantity=line_item.quantity,
+                product_image=line_item.image if 'image' in line_item else None,
+            )
+        else:
+            line.price += Decimal(line_item.amount_total) / 100
+            line.quantity += line_item.quantity
+
+    try:
+        with transaction.atomic():
+            order = Order.objects.create(
+                user=user,
+                stripe_checkout_id=checkout_session_id,
+                total=sum(line.price for line in lines.values()),
+                item_count=sum(line.quantity for line in lines.values()),
+                currency=currency,
+            )
+            for line in lines.values():
+                line.order = order
+            PastOrder.objects.bulk_create(lines.values())
+    except IntegrityError:
+        # The redirect and the webhook raced, and the other one won
+        return False
+    return True
+
+
+def backfill_orders(batch_size=500):
+    """
+    Give every PastOrder without an Order its header, batch_size lines at a time.
+
+    Lines sharing a checkout id become one order; lines without one (recorded
+    before checkout ids were kept) become an order each. Returns how many
+    orders were created.
+    """
+    created = 0
+    while True:
+        lines = list(PastOrder.objects.filter(order__isnull=True).order_by('id')[:batch_size])
+        if not lines:
+            return created
+
+        # Pull in the rest of any checkout the batch cut in half
+        checkout_ids = {line.stripe_checkout_id for line in lines if line.stripe_checkout_id}
+        if checkout_ids:
+            lines = list(PastOrder.objects.filter(
+                Q(id__in=[line.id for line in lines]) | Q(stripe_checkout_id__in=checkout_ids),
+                order__isnull=True,
+            ))
+
+        groups = defaultdict(list)
+        for line in lines:
+            groups[line.stripe_checkout_id or line.id].append(line)
+
+        with transaction.atomic():
+            for group in groups.values():
+                first = min(group, key=lambda line: line.created_at)
+                order = Order.objects.create(
+                    user_id=first.user_id,
+                    stripe_checkout_id=first.stripe_checkout_id,
+                    total=sum(line.price for line in group),
+                    item_count=sum(line.quantity for line in group),
+                    currency=first.currency,
+                    created_at=first.created_at,
+                )
+                PastOrder.objects.filter(id__in=[line.id for line in group]).update(order=order)
+                created += 1
@@ -0,0 +1,64 @@
+"""
+Product search for the shop's `q` parameter.
+
+On SQLite the query runs against the FTS5 index created in migration 0006 and
+results are ranked with bm25 (name matches weigh most, then SKU, then
+description). Other databases fall back to icontains filtering.
+"""
+import re
+
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+FTS_TABLE = 'a_stripe_product_fts'
+
+# Column weights for bm25, in index column order: name, sku, description.
+RANK_WEIGHTS = (10.0, 5.0, 1.0)
+
+_fts_available = {}
+
+
+def fts_available():
+    key = connection.settings_dict['NAME']
+    if key not in _fts_available:
+        _fts_available[key] = (
+            connection.vendor == 'sqlite'
+            and FTS_TABLE in connection.introspection.table_names()
+        )
+    return _fts_available[key]
+
+
+def build_match(query):
+    """Turn free text into an FTS5 query: every word must match as a prefix."""
+    terms = re.findall(r'\w+', query.lower())
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def search_products(products, query):
+    """
+    Filter a Product queryset down to matches for query, best match first.
+
+    The result is still a queryset, so slicing it pages in SQL.
+    """
+    if not fts_available():
+        return products.filter(
+            Q(name__icontains=query) | Q(sku__icontains=query) | Q(description__icontains=query)
+        ).order_by('name', 'id')
+
+    match = build_match(query)
+    if not match:
+        return products.none()
+
+    weights = ', '.join(str(weight) for weight in RANK_WEIGHTS)
+    table = products.model._meta.db_table
+    return products.filter(
+        id__in=RawSQL(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [match]),
+    ).annotate(
+        # bm25 needs the MATCH in its own query; the rowid constraint keeps it to this product's row
+        rank=RawSQL(
+            f'SELECT bm25({FTS_TABLE}, {weights}) FROM {FTS_TABLE} '
+            f'WHERE {FTS_TABLE} MATCH %s AND {FTS_TABLE}.rowid = {table}.id',
+            [match],
+        ),
+    ).order_by('rank', 'id')
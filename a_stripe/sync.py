@@ -0,0 +1,310 @@
+"""
+Sync engine for the local Stripe catalog mirror (Product / Price).
+
+A full sync pages through every product and price in Stripe. A delta sync
+replays the product/price events Stripe recorded since the last cursor, so
+routine runs only touch what actually changed.
+
+Nothing here calls Stripe inside a transaction: on SQLite that would keep
+every other writer locked out for as long as Stripe takes. Products a price
+needs but the mirror lacks are fetched first with fetch_missing_products()
+and handed to the writes as `parents`.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone as dt_timezone
+from itertools import islice
+import logging
+import time
+
+import stripe
+from django.db import transaction
+from django.utils import timezone
+
+from .cache import evict_products
+from .models import Price, Product, SyncCursor
+from .utils import PAGE_SIZE, iter_catalog
+
+logger = logging.getLogger(__name__)
+
+CURSOR_NAME = 'catalog'
+
+CATALOG_EVENT_TYPES = [
+    'product.created',
+    'product.updated',
+    'product.deleted',
+    'price.created',
+    'price.updated',
+    'price.deleted',
+]
+
+# Stripe only keeps events for 30 days; older cursors need a full sync.
+EVENT_RETENTION_SECONDS = 30 * 24 * 60 * 60
+
+
+def _to_dict(obj):
+    if hasattr(obj, 'to_dict'):
+        return obj.to_dict()
+    return dict(obj)
+
+
+def _timestamp(value):
+    if not value:
+        return None
+    return datetime.fromtimestamp(value, tz=dt_timezone.utc)
+
+
+def _stripe_id(value):
+    # Expandable fields come back either as an id or as the full object.
+    if isinstance(value, dict):
+        return value.get('id')
+    return value
+
+
+# Set by batched_catalog_changes(): ids collected for one eviction at the end
+_pending_changes = ContextVar('catalog_pending_changes', default=None)
+
+
+def catalog_changed(*product_ids):
+    """Evict cached entries for these products once the surrounding transaction commits."""
+    pending = _pending_changes.get()
+    if pending is not None:
+        pending.update(product_ids)
+    else:
+        transaction.on_commit(lambda: evict_products(product_ids))
+
+
+@contextmanager
+def batched_catalog_changes():
+    """Collect every catalog_changed() inside the block and evict (bumping the catalog version) just once."""
+    pending = set()
+    token = _pending_changes.set(pending)
+    try:
+        yield
+    finally:
+        _pending_changes.reset(token)
+        if pending:
+            catalog_changed(*pending)
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def _as_of(as_of):
+    # Rows written without a timestamp (on-demand fetches) keep the one they had
+    return {} if as_of is None else {'last_event_created': as_of}
+
+
+def upsert_product(data, as_of=None):
+    """Mirror a Stripe product. as_of is the Stripe timestamp the data is current at."""
+    data = _to_dict(data)
+    metadata = data.get('metadata') or {}
+    images = data.get('images') or []
+
+    product, _ = Product.objects.update_or_create(
+        stripe_id=data['id'],
+        defaults={
+            **_as_of(as_of),
+            'name': data.get('name') or '',
+            'description': data.get('description') or '',
+            'image': images[0] if images else '',
+            'category': metadata.get('category', ''),
+            'sku': metadata.get('sku', ''),
+            'metadata': metadata,
+            'active': data.get('active', True),
+            'stripe_default_price': _stripe_id(data.get('default_price')) or '',
+            'stripe_created': _timestamp(data.get('created')) or timezone.now(),
+        },
+    )
+
+    default_price = data.get('default_price')
+    if isinstance(default_price, dict):
+        upsert_price(default_price, product=product, as_of=as_of)
+    else:
+        _refresh_default_price(product)
+    catalog_changed(product.stripe_id)
+    return product
+
+
+def fetch_missing_products(prices, known=()):
+    """
+    {product_id: Stripe product} for the prices whose product is neither
+    mirrored nor in known (e.g. created earlier in the same batch). Call it
+    outside any transaction.
+    """
+    product_ids = {_stripe_id(_to_dict(price).get('product')) for price in prices} - set(known)
+    product_ids -= set(Product.objects.filter(stripe_id__in=product_ids).values_list('stripe_id', flat=True))
+    return {product_id: stripe.Product.retrieve(product_id) for product_id in sorted(product_ids)}
+
+
+def upsert_price(data, product=None, as_of=None, parents=None):
+    """Mirror a Stripe price. A parent the mirror lacks must be in parents (see fetch_missing_products)."""
+    data = _to_dict(data)
+    product_id = _stripe_id(data.get('product'))
+    if product is None:
+        product = Product.objects.filter(stripe_id=product_id).first()
+        if product is None:
+            # The product event has not arrived yet; mirror the product fetched for it.
+            if product_id not in (parents or {}):
+                raise Product.DoesNotExist(f'{product_id} is not mirrored; fetch it with fetch_missing_products() first')
+            product = upsert_product(parents[product_id])
+
+    price, _ = Price.objects.update_or_create(
+        stripe_id=data['id'],
+        defaults={
+            **_as_of(as_of),
+            'product': product,
+            'unit_amount': data.get('unit_amount'),
+            'currency': data.get('currency') or '',
+            'active': data.get('active', True),
+            'stripe_created': _timestamp(data.get('created')),
+        },
+    )
+    _refresh_default_price(product)
+    catalog_changed(product.stripe_id)
+    return price
+
+
+def _refresh_default_price(product):
+    """Point product.default_price at Stripe's default, else its newest active price."""
+    price = None
+    if product.stripe_default_price:
+        price = product.prices.filter(stripe_id=product.stripe_default_price, active=True).first()
+    if price is None:
+        price = product.prices.filter(active=True).order_by('-stripe_created', '-id').first()
+
+    if product.default_price_id != (price.pk if price else None):
+        product.default_price = price
+        product.save(update_fields=['default_price', 'synced_at'])
+
+
+def delete_product(stripe_id, as_of=None):
+    Product.objects.filter(stripe_id=stripe_id).update(active=False, synced_at=timezone.now(), **_as_of(as_of))
+    catalog_changed(stripe_id)
+
+
+def delete_price(stripe_id, as_of=None):
+    price = Price.objects.filter(stripe_id=stripe_id).select_related('product').first()
+    if price:
+        price.active = False
+        if as_of is not None:
+            price.last_event_created = as_of
+        price.save(update_fields=['active', 'last_event_created', 'synced_at'])
+        _refresh_default_price(price.product)
+        catalog_changed(price.product.stripe_id)
+
+
+def fetch_event_parents(event):
+    """The Stripe calls apply_event may need, made up front: the parent of a price whose product isn't mirrored."""
+    if not event['type'].startswith('price.') or event['type'] == 'price.deleted':
+        return {}
+    return fetch_missing_products([event['data']['object']])
+
+
+def apply_event(event, parents=None):
+    """
+    Apply a single product.* / price.* event to the mirror, with parents from
+    fetch_event_parents().
+
+    Stripe doesn't deliver events in order and the queue retries failures
+    later, so an event older than what the row already reflects is skipped.
+    Returns False when it was.
+    """
+    event_type = event['type']
+    obj = event['data']['object']
+    created = event.get('created') or 0
+
+    model = Product if event_type.startswith('product.') else Price
+    if model.objects.select_for_update().filter(stripe_id=obj['id'], last_event_created__gt=created).exists():
+        logger.info('Skipping %s for %s: the mirror already has newer data', event_type, obj['id'])
+        return False
+
+    if event_type == 'product.deleted':
+        delete_product(obj['id'], as_of=created)
+    elif event_type.startswith('product.'):
+        upsert_product(obj, as_of=created)
+    elif event_type == 'price.deleted':
+        delete_price(obj['id'], as_of=created)
+    elif event_type.startswith('price.'):
+        upsert_price(obj, as_of=created, parents=parents)
+    return True
+
+
+def _get_cursor():
+    cursor, _ = SyncCursor.objects.get_or_create(name=CURSOR_NAME)
+    return cursor
+
+
+def full_sync():
+    """
+    Mirror every product and price. Products no longer in Stripe are deactivated.
+
+    Every page's worth of objects is written in its own short transaction, so
+    the database is never locked while waiting on Stripe; the caches are
+    evicted once at the end.
+    """
+    started = int(time.time())
+    seen = set()
+
+    with batched_catalog_changes():
+        for batch in _batches(iter_catalog(stripe.Product), PAGE_SIZE):
+            with transaction.atomic():
+                for product in batch:
+                    seen.add(upsert_product(product, as_of=started).stripe_id)
+        for batch in _batches(iter_catalog(stripe.Price), PAGE_SIZE):
+            # Products created since the product pages were read
+            parents = fetch_missing_products(batch, known=seen)
+            with transaction.atomic():
+                for price in batch:
+                    upsert_price(price, as_of=started, parents=parents)
+
+        with transaction.atomic():
+            removed = list(Product.objects.filter(active=True).exclude(stripe_id__in=seen).values_list('stripe_id', flat=True))
+            Product.objects.filter(stripe_id__in=removed).update(active=False)
+            catalog_changed(*removed)
+
+            cursor = _get_cursor()
+            cursor.last_event_created = started
+            cursor.last_full_sync = timezone.now()
+            cursor.save()
+
+    logger.info('Full catalog sync mirrored %s products', len(seen))
+    return len(seen)
+
+
+def delta_sync():
+    """Replay catalog events newer than the cursor. Falls back to a full sync when stale."""
+    cursor = _get_cursor()
+    if not cursor.last_event_created or cursor.last_event_created < time.time() - EVENT_RETENTION_SECONDS:
+        full_sync()
+        return 0
+
+    events = stripe.Event.list(
+        types=CATALOG_EVENT_TYPES,
+        created={'gt': cursor.last_event_created},
+        limit=PAGE_SIZE,
+    ).auto_paging_iter()
+
+    # Stripe lists newest first; replay oldest first so later updates win.
+    events = sorted(events, key=lambda event: event['created'])
+
+    replayed_products = {
+        event['data']['object']['id'] for event in events
+        if event['type'].startswith('product.') and event['type'] != 'product.deleted'
+    }
+    parents = fetch_missing_products(
+        [event['data']['object'] for event in events if event['type'] in ('price.created', 'price.updated')],
+        known=replayed_products,
+    )
+
+    with batched_catalog_changes(), transaction.atomic():
+        for event in events:
+            apply_event(event, parents)
+            cursor.last_event_created = max(cursor.last_event_created, event['created'])
+        cursor.save()
+
+    logger.info('Delta catalog sync applied %s events', len(events))
+    return len(events)
@@ -0,0 +1,133 @@
+"""
+Stripe call budgets for tests.
+
+assertNumStripeCalls is the Stripe counterpart of assertNumQueries, usable as
+a context manager or a decorator (on sync or async tests):
+
+    with assertNumStripeCalls({'products': 1}):
+        self.client.get(reverse('product', args=['prod_missing']))
+
+    @patch('stripe.checkout.Session.retrieve')
+    @assertNumStripeCalls({'checkout.sessions': 2, 'customers': 1})
+    def test_payment_successful(self, mock_retrieve): ...
+
+Calls are counted per resource ('products', 'prices', 'customers',
+'checkout.sessions', ...). Both real requests (through the stripe library's
+requestor, e.g. to the bench FakeStripe) and calls to mocked resource methods
+count. Mocks are picked up when the budget starts, so enter it inside the
+patches: as a decorator, list it below the @patch decorators.
+
+StorefrontTestMixin adds the query plan and htmx paging checks shared by the
+shop and profile tests.
+"""
+from collections import Counter
+from contextlib import ContextDecorator
+import functools
+import inspect
+import sys
+import threading
+from unittest import mock
+from urllib.parse import urlsplit
+
+from stripe._api_requestor import _APIRequestor
+from stripe._api_resource import APIResource
+
+from .client import STRIPE_ID_RE
+
+
+def resource_name(url):
+    """'checkout.sessions' for /v1/checkout/sessions/cs_123/line_items."""
+    path = STRIPE_ID_RE.sub('/{id}', urlsplit(url).path)
+    segments = path.strip('/').split('/')[1:]  # drop the v1 prefix
+    if '{id}' in segments:
+        segments = segments[:segments.index('{id}')]
+    return '.'.join(segments)
+
+
+def mocked_resource_methods():
+    """(mock, resource) for every mock currently patched onto a loaded Stripe resource class."""
+    for module in list(sys.modules.values()):
+        if not getattr(module, '__name__', '').startswith('stripe.'):
+            continue
+        for cls in list(vars(module).values()):
+            if not (isinstance(cls, type) and issubclass(cls, APIResource)) or cls is APIResource:
+                continue
+            for value in list(vars(cls).values()):
+                if isinstance(value, mock.NonCallableMock):
+                    yield value, resource_name(cls.class_url())
+
+
+class assertNumStripeCalls(ContextDecorator):
+    """Fail unless exactly the expected Stripe calls were made: a total, or a {resource: count} dict."""
+
+    def __init__(self, expected):
+        self.expected = expected
+
+    def __enter__(self):
+        self.counts = Counter()
+        self._lock = threading.Lock()
+        self._mocks = {id(m): (m, resource, m.call_count) for m, resource in mocked_resource_methods()}
+
+        request = _APIRequestor.request
+        budget = self
+
+        @functools.wraps(request)
+        def counting_request(requestor, method, url, *args, **kwargs):
+            with budget._lock:
+                budget.counts[resource_name(url)] += 1
+            return request(requestor, method, url, *args, **kwargs)
+
+        self._patch = mock.patch.object(_APIRequestor, 'request', counting_request)
+        self._patch.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._patch.stop()
+        if exc_type:
+            return False
+
+        counts = Counter(self.counts)
+        for m, resource, before in self._mocks.values():
+            counts[resource] += m.call_count - before
+        counts = {resource: count for resource, count in counts.items() if count}
+
+        if isinstance(self.expected, int):
+            if sum(counts.values()) != self.expected:
+                raise AssertionError(f'{sum(counts.values())} Stripe calls made, {self.expected} expected: {counts}')
+        elif counts != {resource: count for resource, count in self.expected.items() if count}:
+            raise AssertionError(f'Stripe calls {counts} made, {self.expected} expected')
+        return False
+
+    def __call__(self, func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self._recreate_cm():
+                    return await func(*args, **kwargs)
+            return wrapper
+        return super().__call__(func)
+
+
+class StorefrontTestMixin:
+    """Helpers for TestCase subclasses: SQLite query plans and infinite-scroll lists."""
+
+    def assertUsesIndex(self, queryset, index=None):
+        """queryset is served by an index (index, if given) with no table scan and no separate sort step."""
+        plan = queryset.explain()
+        self.assertIn(index or 'USING INDEX', plan)
+        self.assertNotIn('SCAN', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def follow_pages(self, url, params, items, partial_template, page_template):
+        """
+        Load url, then every batch its "revealed" sentinel asks for, and return
+        items(response) for all of them in order.
+        """
+        response = self.client.get(url, params)
+        collected = list(items(response))
+        while response.context['next_cursor']:
+            response = self.client.get(url, dict(params, cursor=response.context['next_cursor']), HTTP_HX_REQUEST='true')
+            self.assertTemplateUsed(response, partial_template)
+            self.assertTemplateNotUsed(response, page_template)
+            collected += items(response)
+        return collected
@@ -1,6 +1,11 @@
+from django.conf import settings
 from django.urls import path
 from .views import *
 
+if settings.STRIPE_ASYNC_VIEWS:
+    # Served under ASGI: swap in the async versions of the Stripe-backed views
+    from .async_views import cart_view, checkout_view, payment_successful, product_view, shop_view
+
 urlpatterns = [
     path('', shop_view, name='shop'),
     path('product/<product_id>', product_view, name='product'),
@@ -10,9 +15,10 @@ urlpatterns = [
     path('payment_successful/', payment_successful, name='payment_successful'),
     path('payment_cancelled/', payment_cancelled, name='payment_cancelled'),
     path('stripe_webhook/', stripe_webhook, name='stripe_webhook'),
+    path('stripe_metrics/', stripe_metrics, name='stripe_metrics'),
     path('add_to_cart/<product_id>', add_to_cart, name='add_to_cart'),
-    path('hx_menu_cart/', hx_menu_cart, name='hx_menu_cart'),
     path('update_checkout/<product_id>', update_checkout, name='update_checkout'),
+    path('update_cart/', update_cart, name='update_cart'),
     # HERE 
     path('remove_from_cart/<product_id>', remove_from_cart, name='remove_from_cart'),
     # whos calling that
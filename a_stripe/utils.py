@@ -1,32 +1,182 @@
 from django.conf import settings
 from django.urls import reverse
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from django.core.cache import cache
+from django.db.models import Q
+from django.http import Http404
 import stripe
+from .cache import missing_product_key, product_cache_key
+from .fetch import fetch_all
+from .models import Product
+
+# Largest page Stripe list endpoints will return.
+PAGE_SIZE = 100
+
+
+def iter_catalog(resource=stripe.Product, page_size=PAGE_SIZE, prefetch=True, **params):
+    """
+    Stream every object from a Stripe list endpoint, one page at a time.
+
+    While the caller works through a page, the next page is fetched in a
+    background thread. Stopping early (breaking out, islice, close()) ends the
+    paging, so at most one page beyond the one being consumed is requested.
+    """
+    def fetch(starting_after=None):
+        page_params = dict(params, limit=page_size)
+        if starting_after:
+            page_params['starting_after'] = starting_after
+        return resource.list(**page_params)
+
+    executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+    try:
+        page = fetch()
+        while True:
+            data = list(page['data'])
+            has_more = page['has_more'] and bool(data)
+
+            next_page = None
+            if has_more and executor:
+                next_page = executor.submit(fetch, data[-1]['id'])
+
+            yield from data
+
+            if not has_more:
+                return
+            page = next_page.result() if next_page else fetch(data[-1]['id'])
+    finally:
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def catalog_products():
+    return Product.objects.filter(active=True).select_related('default_price')
+
+
+def resolve_products(product_ids):
+    """
+    Map Stripe product ids to mirrored products with their default price loaded.
+
+    The mirror is read with one query. Only ids it has never seen are fetched
+    from Stripe, in pages of up to 100 with the default price expanded, so the
+    number of calls does not grow with the number of products. Inactive
+    (archived) products are known to be off sale and are left out without
+    asking Stripe, as are ids Stripe doesn't know either. Those are remembered
+    for CATALOG_MISS_TIMEOUT (or until the catalog changes), so requests for
+    made-up ids don't each cost a Stripe call.
+    """
+    # Imported here because the sync engine pages through Stripe with iter_catalog.
+    from .sync import batched_catalog_changes, upsert_product
+
+    product_ids = list(dict.fromkeys(product_ids))
+    mirrored = Product.objects.select_related('default_price')
+    products = mirrored.in_bulk(product_ids, field_name='stripe_id')
+    missing = [product_id for product_id in product_ids if product_id not in products]
+    if missing:
+        known_missing = cache.get_many([missing_product_key(product_id) for product_id in missing])
+        missing = [product_id for product_id in missing if missing_product_key(product_id) not in known_missing]
+
+    listings = fetch_all(
+        partial(_list_products, missing[start:start + PAGE_SIZE])
+        for start in range(0, len(missing), PAGE_SIZE)
+    )
+    with batched_catalog_changes():
+        for listing in listings:
+            for product in listing:
+                upsert_product(product)
+
+    if missing:
+        products.update(mirrored.in_bulk(missing, field_name='stripe_id'))
+        cache.set_many(
+            {missing_product_key(product_id): True for product_id in missing if product_id not in products},
+            settings.CATALOG_MISS_TIMEOUT,
+        )
+
+    return {
+        product_id: products[product_id]
+        for product_id in product_ids
+        if product_id in products and products[product_id].active
+    }
+
+
+def _list_products(product_ids):
+    listing = stripe.Product.list(ids=product_ids, limit=PAGE_SIZE, expand=['data.default_price'])
+    return list(listing.auto_paging_iter())
+
+
+def get_product(product_id):
+    product = resolve_products([product_id]).get(product_id)
+    if product is None:
+        raise Http404('No such product')
+    return product
+
+
+def shop_page(products, cursor=None, page_size=12, ranked=False):
+    """
+    One batch of the shop grid and the cursor for the batch after it.
+
+    Browsing seeks past the last product shown (newest first) along
+    product_shop_idx, so each batch is an index range scan however deep the
+    shopper scrolls. Ranked search results
+    have no stable sort key, so their cursor is an offset into the ranking.
+    """
+    if ranked:
+        offset = int(cursor) if cursor and cursor.isdigit() else 0
+        batch = list(products[offset:offset + page_size + 1])
+        next_cursor = str(offset + page_size)
+    else:
+        products = products.order_by('-stripe_created', '-id')
+        last = Product.objects.filter(pk=cursor).values('stripe_created', 'id').first() if cursor and cursor.isdigit() else None
+        if last:
+            # The redundant <= bound gives the index a range to seek to, not just rows to skip
+            products = products.filter(
+                Q(stripe_created__lt=last['stripe_created']) | Q(id__lt=last['id']),
+                stripe_created__lte=last['stripe_created'],
+            )
+        batch = list(products[:page_size + 1])
+        next_cursor = str(batch[page_size - 1].pk) if len(batch) > page_size else None
+
+    if len(batch) <= page_size:
+        next_cursor = None
+    return batch[:page_size], next_cursor
+
 
 def get_product_details(product):
-    prices = stripe.Price.list(product=product['id'])
-    price = prices.data[0]
+    price = product.default_price
 
     product_details = {
-        'id': product['id'],
-        'name': product['name'],
-        'image': product['images'][0],
-        'description': product['description'],
-        'price': price['unit_amount'] / 100
+        'id': product.stripe_id,
+        'name': product.name,
+        'image': product.image,
+        'description': product.description,
+        'price': price.unit_amount / 100 if price and price.unit_amount is not None else 0,
+        'price_id': price.stripe_id if price else None,
     }
 
     return product_details
 
 
+def get_cached_product_details(product_id):
+    """
+    get_product_details for a single product id. The cached copy is evicted by
+    the sync engine whenever the product or its prices change.
+    """
+    key = product_cache_key(product_id)
+    product_details = cache.get(key)
+    if product_details is None:
+        product_details = get_product_details(get_product(product_id))
+        cache.set(key, product_details, settings.CATALOG_CACHE_TIMEOUT)
+    return dict(product_details)
+
+
 def create_checkout_session(cart, customer_email):
-    line_items = []
-    for item in cart:
-        prices = stripe.Price.list(product=item['id'])
-        price = prices.data[0]
-        line_items.append({
-            'price': price.id,
-            'quantity': item['quantity']
-        })
-    
+    # Cart lines are priced through resolve_products, so no per-line price lookups here.
+    line_items = [
+        {'price': item['price_id'], 'quantity': item['quantity']}
+        for item in cart
+        if item['price_id']
+    ]
+
     checkout_session = stripe.checkout.Session.create(
         line_items = line_items,
         payment_method_types = ['card'],
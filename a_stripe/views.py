@@ -1,4 +1,4 @@
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse
 import stripe
 from django.shortcuts import render, redirect
 from django.urls import reverse
@@ -6,11 +6,22 @@ from django.conf import settings
 from django.views.decorators.http import require_POST
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.decorators import login_required
-from a_stripe.models import CheckoutSession, PastOrder, UserPayment
+from django.contrib.admin.views.decorators import staff_member_required
+from a_stripe.models import CheckoutSession
 from django.http import HttpResponseRedirect
-stripe.api_key = settings.STRIPE_TEST_KEY
-from .utils import create_checkout_session, get_product_details
-from .cart import Cart
+from .utils import catalog_products, create_checkout_session, get_cached_product_details, get_product_details, shop_page
+from .search import search_products
+from .fetch import fetch_all
+from .client import metrics
+from .events import enqueue
+from .orders import orders_recorded, record_orders
+from .cache import catalog_version
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+from django.utils.safestring import mark_safe
+import json
+from functools import partial
+from .cart import Cart, CartFull
 from .forms import *
 import logging
 logger = logging.getLogger(__name__)
@@ -18,48 +29,99 @@ logger = logging.getLogger(__name__)
 # Create your views here.
 
 
+SHOP_PAGE_SIZE = 12
+
+
+def shop_context(query, cursor):
+    products_list = catalog_products().filter(category='shop', default_price__isnull=False)
+
+    # Only include product if it matches query or no query provided
+    if query:
+        products_list = search_products(products_list, query)
+
+    batch, next_cursor = shop_page(products_list, cursor, SHOP_PAGE_SIZE, ranked=bool(query))
+    return {
+        'products': [get_product_details(product) for product in batch],
+        'next_cursor': next_cursor,
+        'query': query,
+    }
+
+
+def shop_grid_context(query, cursor):
+    """
+    Context for partials/shop-grid.html. The grid is cached as a fragment keyed
+    by catalog version, query and cursor; when it is, the catalog isn't queried.
+    """
+    context = {
+        'query': query,
+        'cursor': cursor or '',
+        'catalog_version': catalog_version(),
+        'fragment_timeout': settings.CATALOG_CACHE_TIMEOUT,
+    }
+    cached_grid = cache.get(make_template_fragment_key('shop-grid', [context['catalog_version'], query, context['cursor']]))
+    if cached_grid is not None:
+        context['cached_grid'] = mark_safe(cached_grid)
+    else:
+        context.update(shop_context(query, cursor))
+    return context
+
+
 def shop_view(request):
-    query = request.GET.get('q', '').lower()
-    products_list = stripe.Product.list()
-    products = []
+    query = request.GET.get('q', '').strip()
+    cursor = request.GET.get('cursor')
+    context = shop_grid_context(query, cursor)
 
-    for product in products_list['data']:
-        if product.get('metadata', {}).get('category') == "shop":
-            name = product.get('name', '').lower()
-            sku = product.get('metadata', {}).get('sku', '').lower()
-            
-            # Only include product if it matches query or no query provided
-            if not query or query in name or query in sku:
-                products.append(get_product_details(product))
+    # Later batches are requested by the grid's "revealed" sentinel
+    if request.htmx and cursor:
+        return render(request, 'a_stripe/partials/shop-grid.html', context)
+    return render(request, 'a_stripe/shop.html', context)
 
-    return render(request, 'a_stripe/shop.html', {'products': products})
 
+# Product page fragments, the same for every visitor (see product.html), by context name
+PRODUCT_FRAGMENTS = {'cached_image': 'product-image', 'cached_summary': 'product-summary', 'cached_body': 'product-body'}
 
-def product_view(request, product_id):
 
-    product = stripe.Product.retrieve(product_id)
-    product_details = get_product_details(product)
+def product_context(request, product_id):
+    """
+    Context for product.html. Its fragments are cached per catalog version and
+    product; when all of them are, the product details aren't loaded.
+    """
+    context = {
+        'catalog_version': catalog_version(),
+        'fragment_timeout': settings.CATALOG_CACHE_TIMEOUT,
+    }
+    keys = {
+        name: make_template_fragment_key(fragment, [context['catalog_version'], product_id])
+        for name, fragment in PRODUCT_FRAGMENTS.items()
+    }
+    cached = cache.get_many(keys.values())
+    if len(cached) == len(keys):
+        context.update({name: mark_safe(cached[key]) for name, key in keys.items()})
+        product_details = {'id': product_id}  # All the cart button needs
+    else:
+        product_details = get_cached_product_details(product_id)
 
     cart = Cart(request)
     product_details['in_cart'] = product_id in cart.cart_session
+    context['product'] = product_details
+    return context
 
-    return render(request, 'a_stripe/product.html', {'product': product_details})
-
-def hx_menu_cart(request):
-    return render(request, 'a_stripe/partials/menu-cart.html')
 
+def product_view(request, product_id):
+    return render(request, 'a_stripe/product.html', product_context(request, product_id))
 
+@require_POST
 def add_to_cart(request, product_id):
+    product_details = get_cached_product_details(product_id)
     cart = Cart(request)
-    cart.add(product_id)
+    try:
+        cart.add(product_id)
+    except CartFull as e:
+        product_details['error'] = str(e)
 
-    product = stripe.Product.retrieve(product_id)
-    product_details = get_product_details(product)
     product_details['in_cart'] = product_id in cart.cart_session
 
-    response = render(request, 'a_stripe/partials/cart-button.html', {'product': product_details})
-    response['HX-Trigger'] = 'hx_menu_cart'
-    return response
+    return render(request, 'a_stripe/partials/cart-button.html', {'product': product_details, 'oob_badge': True})
 
 
 @login_required
@@ -72,10 +134,7 @@ def checkout_view(request):
         form = ShippingForm(request.POST, instance=shipping_info)
         if form.is_valid():
             try:
-                shipping_info = form.save(commit=False)
-                shipping_info.user = request.user
-                shipping_info.email = form.cleaned_data['email'].lower()
-                shipping_info.save()
+                shipping_info = save_shipping_info(form, request.user)
                 
                 cart = Cart(request)
                 
@@ -114,6 +173,14 @@ def checkout_view(request):
     }
     return render(request, 'a_stripe/checkout.html', context)
 
+def save_shipping_info(form, user):
+    shipping_info = form.save(commit=False)
+    shipping_info.user = user
+    shipping_info.email = form.cleaned_data['email'].lower()
+    shipping_info.save()
+    return shipping_info
+
+
 def payment_successful(request):
     checkout_session_id = request.GET.get('session_id', None)
     customer = None  # Default if session retrieval fails
@@ -121,98 +188,139 @@ def payment_successful(request):
     if checkout_session_id:
         session = stripe.checkout.Session.retrieve(checkout_session_id)
         customer_id = session.customer
-        customer = stripe.Customer.retrieve(customer_id)
-
-        # Fetch line items for the session
-        line_items = stripe.checkout.Session.list_line_items(session.id)
-
-        # Save Stripe Customer ID to user profile if authenticated
-        if request.user.is_authenticated:
-            profile = request.user.profile
-            if not profile.stripe_customer_id:
-                profile.stripe_customer_id = customer_id
-                profile.save()
-
-        # Mark checkout session as paid in dev mode (optional)
-        if settings.DEBUG:
-            checkout = CheckoutSession.objects.get(checkout_id=checkout_session_id)
-            checkout.has_paid = True
-            checkout.save()
-        # Save each line item to the PastOrder model
-        for line_item in line_items.data:
-            product_name = line_item.description  # Product name
-            price = line_item.amount_total / 100.0  # Stripe amount is in cents
-            currency = session.currency  # Currency from the session
-            quantity = line_item.quantity  # Product quantity
-            product_image = line_item.image if 'image' in line_item else None  # Product image URL if available
-
-            # Create PastOrder instance for each product in the checkout session
-            PastOrder.objects.create(
-                user=request.user,
-                stripe_checkout_id=session.id,
-                stripe_product_id=line_item.price.product,
-                product_name=product_name,
-                price=price,
-                currency=currency,
-                quantity=quantity,
-                product_image=product_image,
-            )
-
-        # Clear cart session after successful payment
-        if settings.CART_SESSION_ID in request.session:
-            del request.session[settings.CART_SESSION_ID]
+
+        if orders_recorded(session.id):
+            # Reload, or the webhook got there first: only the customer is needed
+            customer = stripe.Customer.retrieve(customer_id)
+            line_items = None
+        else:
+            # Fetch the customer and the session's line items side by side
+            customer, line_items = fetch_all([
+                partial(stripe.Customer.retrieve, customer_id),
+                partial(stripe.checkout.Session.list_line_items, session.id, limit=100),
+            ])
+
+        record_payment(request, session, customer_id, line_items)
 
     return render(request, 'a_stripe/payment_successful.html', {'customer': customer})
 
 
+def record_payment(request, session, customer_id, line_items):
+    """Database side of a successful payment: profile, checkout status, past orders, cart."""
+    # Save Stripe Customer ID to user profile if authenticated
+    if request.user.is_authenticated:
+        profile = request.user.profile
+        if not profile.stripe_customer_id:
+            profile.stripe_customer_id = customer_id
+            profile.save()
+
+    # Mark checkout session as paid in dev mode (optional)
+    if settings.DEBUG:
+        CheckoutSession.objects.filter(checkout_id=session.id).update(has_paid=True)
+
+    # Save the line items as past orders, once per checkout session
+    if line_items is not None and request.user.is_authenticated:
+        record_orders(request.user, session.id, session.currency, line_items.data)
+
+    # Empty the cart after successful payment
+    Cart(request).clear()
+
+
 def remove_from_cart(request,product_id):
     cart = Cart(request)
     cart.remove(product_id)
     return redirect(reverse('cart'))
 
+@require_POST
+def update_cart(request):
+    """
+    Apply every quantity-<product_id> and remove=<product_id> in the POST as
+    one change, and answer with out-of-band swaps for the line totals it
+    touched, the cart total and the header badge.
+    """
+    try:
+        quantities = {
+            key.removeprefix('quantity-'): int(value)
+            for key, value in request.POST.items() if key.startswith('quantity-')
+        }
+    except ValueError:
+        return HttpResponseBadRequest('Quantities must be whole numbers.')
+    if quantities and len(catalog_products().in_bulk(list(quantities), field_name='stripe_id')) < len(quantities):
+        return HttpResponseBadRequest('Unknown product.')
+    removed = request.POST.getlist('remove')
+
+    cart = Cart(request)
+    error = None
+    try:
+        changed = cart.update(quantities, removed)
+    except CartFull as e:
+        changed, error = set(), str(e)
+
+    # Only the changed lines are priced; the total comes from the cart's running total
+    return render(request, 'a_stripe/partials/cart-update.html', {
+        'lines': [
+            {'id': product_id, 'total_price': cart.line_total(product_id)}
+            for product_id in changed if product_id in cart.cart_session
+        ],
+        'removed': [product_id for product_id in removed if product_id in changed],
+        'error': error,
+    })
+
+
 def cart_view(request):
-    quantity = list(range(1,11))
+    quantity = list(range(1, settings.CART_MAX_QUANTITY + 1))
     return render(request, 'a_stripe/cart.html', {'quantity_range': quantity})
 
 def update_checkout(request, product_id):
-    quantity = int(request.POST.get('quantity', 1))
+    try:
+        quantity = int(request.POST.get('quantity', 1))
+    except ValueError:
+        return HttpResponseBadRequest('Quantities must be whole numbers.')
+    product_details = get_cached_product_details(product_id)
     cart = Cart(request)
-    cart.add(product_id, quantity)
-
-    product = stripe.Product.retrieve(product_id)
-
-    product_details = get_product_details(product)
+    error = None
+    try:
+        cart.add(product_id, quantity)
+    except CartFull as e:
+        error = str(e)
 
-    product_details['total_price'] = product_details['price'] * quantity
+    # Only this line is priced; the total comes from the cart's running total
+    if product_id in cart.cart_session:
+        product_details['total_price'] = cart.line_total(product_id)
+    else:
+        product_details = None
 
-    response = render(request, 'a_stripe/partials/checkout-total.html', {'product': product_details})
-    response['HX-Trigger'] = 'hx_menu_cart'
-    return response
+    return render(request, 'a_stripe/partials/checkout-total.html', {
+        'product': product_details, 'error': error, 'oob_badge': True,
+    })
 
 
 def payment_cancelled(request):
     return render(request, 'a_stripe/payment_cancelled.html')  
 
+@staff_member_required
+def stripe_metrics(request):
+    """This process's Stripe call counts, errors and latency histograms per endpoint, as JSON."""
+    return JsonResponse(metrics.snapshot())
+
+
 @require_POST
 @csrf_exempt
 def stripe_webhook(request):
     endpoint_secret = settings.STRIPE_WEBHOOK_SECRET
     payload = request.body
-    signature_header = request.META['HTTP_STRIPE_SIGNATURE']
+    signature_header = request.META.get('HTTP_STRIPE_SIGNATURE', '')
     try:
-        event = stripe.Webhook.construct_event(
+        stripe.Webhook.construct_event(
             payload, signature_header, endpoint_secret
         )
+        event = json.loads(payload)
     except:
         return HttpResponse(status=400)
 
-    if event['type'] == 'checkout.session.completed':
-        session = event['data']['object']
-        checkout_session_id = session.get('id')
-        user_payment = UserPayment.objects.get(stripe_checkout_id=checkout_session_id)
-        user_payment.has_paid = True
-        user_payment.save()
-    
+    # The process_stripe_events worker does the actual work; redeliveries are ignored
+    enqueue(event)
+
     return HttpResponse(status=200)
 
 
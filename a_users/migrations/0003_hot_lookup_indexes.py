@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_users', '0002_profile_stripe_customer_id'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='profile',
+            name='stripe_customer_id',
+            field=models.CharField(blank=True, db_index=True, max_length=255, null=True),
+        ),
+    ]
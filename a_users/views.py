@@ -1,18 +1,39 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.urls import reverse
-from a_stripe.models import PastOrder, UserPayment
+from a_stripe.models import Order, PastOrder, UserPayment
 from .forms import *
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.contrib import messages
 from allauth.account.utils import send_email_confirmation
 from django.contrib.auth import logout
-import stripe
-from django.conf import settings
-stripe.api_key = settings.STRIPE_TEST_KEY
+from django.db.models import Exists, OuterRef, Q
 
 # Create your views here.
 
+ORDER_PAGE_SIZE = 20
+
+
+def order_history_page(orders, cursor=None, page_size=ORDER_PAGE_SIZE):
+    """
+    One batch of order history, newest first, and the cursor for the next batch.
+
+    The cursor is the id of the last order shown; the next batch seeks past its
+    (created_at, id) on the user's order index, so no batch reads more than
+    page_size + 1 rows however long the history is.
+    """
+    orders = orders.order_by('-created_at', '-id')
+    last = orders.filter(pk=cursor).values('created_at', 'id').first() if cursor and cursor.isdigit() else None
+    if last:
+        orders = orders.filter(
+            Q(created_at__lt=last['created_at'])
+            | Q(created_at=last['created_at'], id__lt=last['id'])
+        )
+    batch = list(orders[:page_size + 1])
+    next_cursor = str(batch[page_size - 1].pk) if len(batch) > page_size else None
+    return batch[:page_size], next_cursor
+
+
 def profile_view(request, username=None):
     # Resolve profile
     if username:
@@ -23,27 +44,36 @@ def profile_view(request, username=None):
         except:
             return redirect('account_login')
 
-    # Start with all past orders
-    past_orders = PastOrder.objects.filter(user=request.user)
+    # Start with all orders; their line items come in one extra query per batch
+    orders = Order.objects.filter(user=request.user).prefetch_related('items')
 
     # Optional: filter by order ID (search by number)
     query = request.GET.get('q')
     if query:
-        past_orders = past_orders.filter(id=query)
+        orders = orders.filter(id=query)
 
-    # Optional: filter by product name (case-insensitive)
+    # Optional: orders containing a product (case-insensitive)
     product_filter = request.GET.get('product')
     if product_filter:
-        past_orders = past_orders.filter(product_name__icontains=product_filter)
+        orders = orders.filter(Exists(
+            PastOrder.objects.filter(order=OuterRef('pk'), product_name__icontains=product_filter)
+        ))
 
-    # Final ordering
-    past_orders = past_orders.order_by('-created_at')
+    # One batch at a time, newest first
+    cursor = request.GET.get('cursor')
+    orders, next_cursor = order_history_page(orders, cursor)
 
     context = {
         'profile': profile,
-        'past_orders': past_orders,
+        'orders': orders,
+        'next_cursor': next_cursor,
+        'query': query,
+        'product_filter': product_filter,
     }
 
+    # Later batches are requested by the list's "revealed" sentinel
+    if request.htmx and cursor:
+        return render(request, 'a_users/partials/order-list.html', context)
     return render(request, 'a_users/profile.html', context)
 
 @login_required